@@ -48,6 +48,10 @@ class RobotTeleop:
         self.auto_execute = {}
         self.end_effector_link_data = {}
 
+        # control frame motion below these (meters, radians) is treated as sensor noise
+        self.translation_threshold = 0.001
+        self.rotation_threshold = 0.005
+
         # interactive marker server
         self.server = InteractiveMarkerServer(str(self.robot_name + "_teleop"))
         rospy.Subscriber(str(self.robot_name + "/joint_states"), sensor_msgs.msg.JointState, self.joint_state_callback)
@@ -98,13 +102,15 @@ class RobotTeleop:
         # Create EndEffectorHelper objects to help with EE displays
         for n in self.moveit_interface.get_end_effector_names() :
             self.end_effector_link_data[n] = EndEffectorHelper(self.robot_name, n, self.moveit_interface.get_control_frame(n), self.tf_listener)
+            self.end_effector_link_data[n].set_pose_cache(self.moveit_interface.get_pose_cache())
+            self.end_effector_link_data[n].set_frame_tracker(self.moveit_interface.get_frame_tracker())
             # ee_links = self.moveit_interface.get_group_links(n)
             # ee_links.append(self.moveit_interface.get_control_frame(n))
             self.end_effector_link_data[n].populate_data(self.moveit_interface.get_group_links(n), self.moveit_interface.get_urdf_model(), self.moveit_interface.get_srdf_model())
 
-        # set group to display only last point in path by default (can turn on full train from menu)
+        # set group to display a decimated path by default (can switch to the last point only from menu)
         for group in self.group_names :
-            self.moveit_interface.set_display_mode(group, "all_points")
+            self.moveit_interface.set_display_mode(group, "adaptive_points")
 
         # initialize markers
         self.initialize_group_markers()
@@ -185,25 +191,27 @@ class RobotTeleop:
 
     def start_pose_update_thread(self, group) :
         self.group_pose_data[group] = geometry_msgs.msg.PoseStamped()
+        # the control frame is tracked by the interface's shared frame tracker, not a thread per group
         try :
-            self.pose_update_thread[group] = PoseUpdateThread(group, self.root_frame, self.control_frames[group], self.tf_listener, None)
-            self.pose_update_thread[group].start()
+            self.pose_update_thread[group] = self.moveit_interface.get_frame_tracker().register(self.root_frame, self.control_frames[group],
+                translation_threshold=self.translation_threshold, rotation_threshold=self.rotation_threshold)
         except :
-            rospy.logerr("RobotTeleop::start_pose_update_thread() -- unable to start group update thread")
-
-
-    def reset_group_marker(self, group) :
-        _marker_valid = False
-        while not _marker_valid:
-            if self.pose_update_thread[group].is_valid:
-                self.group_pose_data[group] = copy.deepcopy(self.pose_update_thread[group].get_pose_data())
-                self.server.setPose(self.markers[group].name, self.group_pose_data[group])
-                self.server.applyChanges()
-                # What?! do it again? Why? Huh?!
-                self.server.setPose(self.markers[group].name, self.group_pose_data[group])
-                self.server.applyChanges()
-                _marker_valid = True
-            rospy.sleep(0.1)
+            rospy.logerr("RobotTeleop::start_pose_update_thread() -- unable to track group control frame")
+
+
+    def reset_group_marker(self, group, timeout=5.0) :
+        # wait for a pose newer than this call so the marker snaps to where the robot is now
+        pose = self.pose_update_thread[group].wait_for_next_pose(timeout)
+        if pose == None :
+            rospy.logerr(str("RobotTeleop::reset_group_marker() -- no pose for group " + group + " within " + str(timeout) + " seconds"))
+            return False
+        self.group_pose_data[group] = copy.deepcopy(pose)
+        self.server.setPose(self.markers[group].name, self.group_pose_data[group])
+        self.server.applyChanges()
+        # What?! do it again? Why? Huh?!
+        self.server.setPose(self.markers[group].name, self.group_pose_data[group])
+        self.server.applyChanges()
+        return True
 
     def joint_state_callback(self, data) :
         self.joint_data = data
@@ -211,16 +219,31 @@ class RobotTeleop:
     def stored_pose_callback(self, feedback) :
         for p in self.moveit_interface.get_stored_state_list(feedback.marker_name) :
             if self.group_menu_handles[(feedback.marker_name,"Stored Poses",p)] == feedback.menu_entry_id :
+                # plan (and execute) on the group's planning lane so the marker server stays responsive
+                future = self.moveit_interface.create_joint_plan_to_target_async(feedback.marker_name, self.stored_poses[feedback.marker_name][p])
                 if self.auto_execute[feedback.marker_name] :
-                    self.moveit_interface.create_joint_plan_to_target(feedback.marker_name, self.stored_poses[feedback.marker_name][p])
-                    r = self.moveit_interface.execute_plan(feedback.marker_name)
-                    if not r : rospy.logerr(str("RobotTeleop::process_feedback(pose) -- failed moveit execution for group: " + feedback.marker_name + ". re-synching..."))
-                else :
-                    self.moveit_interface.groups[feedback.marker_name].clear_pose_targets()
-                    self.moveit_interface.create_joint_plan_to_target(feedback.marker_name, self.stored_poses[feedback.marker_name][p])
+                    future = self.moveit_interface.execute_plan_async(feedback.marker_name, callback=self.execution_callback, after=future)
                 if self.moveit_interface.get_group_type(feedback.marker_name) == "manipulator" :
-                    rospy.sleep(3)
-                    self.reset_group_marker(feedback.marker_name)
+                    future.add_done_callback(self.resync_callback)
+
+    def resync_callback(self, future) :
+        # a superseded request was dropped before it moved the robot (running executions are
+        # never superseded), so the marker already shows the newer target
+        if future.is_superseded() : return
+        # this runs on the group's planning lane, and waiting for a fresh pose there
+        # would hold up the group's next request
+        resync_thread = threading.Thread(target=self.reset_group_marker, args=(future.group,))
+        resync_thread.daemon = True
+        resync_thread.start()
+
+    def execution_callback(self, future) :
+        # superseded executions were dropped before they started
+        if future.is_superseded() : return
+        try :
+            r = future.get_result()
+        except Exception :
+            r = False
+        if not r : rospy.logerr(str("RobotTeleop::execution_callback() -- failed moveit execution for group: " + future.group + ". re-synching..."))
 
     def process_feedback(self, feedback) :
 
@@ -233,14 +256,10 @@ class RobotTeleop:
                 pt = geometry_msgs.msg.PoseStamped()
                 pt.header = feedback.header
                 pt.pose = feedback.pose
+                # plan (and execute) on the group's planning lane so the marker server stays responsive
+                future = self.moveit_interface.create_plan_to_target_async(feedback.marker_name, pt)
                 if self.auto_execute[feedback.marker_name] :
-                    self.moveit_interface.create_plan_to_target(feedback.marker_name, pt)
-                    r = self.moveit_interface.execute_plan(feedback.marker_name)
-                    if not r :
-                        rospy.logerr(str("RobotTeleop::process_feedback(mouse) -- failed moveit execution for group: " + feedback.marker_name + ". re-synching..."))
-                else :
-                    self.moveit_interface.groups[feedback.marker_name].clear_pose_targets()
-                    self.moveit_interface.create_plan_to_target(feedback.marker_name, pt)
+                    self.moveit_interface.execute_plan_async(feedback.marker_name, callback=self.execution_callback, after=future)
 
         elif feedback.event_type == InteractiveMarkerFeedback.MENU_SELECT:
             if feedback.marker_name in self.group_names :
@@ -262,11 +281,9 @@ class RobotTeleop:
                         self.moveit_interface.set_display_mode(feedback.marker_name, "last_point")
                     else :
                         self.marker_menus[feedback.marker_name].setCheckState( handle, MenuHandler.CHECKED )
-                        self.moveit_interface.set_display_mode(feedback.marker_name, "all_points")
+                        self.moveit_interface.set_display_mode(feedback.marker_name, "adaptive_points")
                 if handle == self.group_menu_handles[(feedback.marker_name,"Execute")] :
-                    r = self.moveit_interface.execute_plan(feedback.marker_name)
-                    if not r :
-                        rospy.logerr(str("RobotTeleop::process_feedback(mouse) -- failed moveit execution for group: " + feedback.marker_name + ". re-synching..."))
+                    self.moveit_interface.execute_plan_async(feedback.marker_name, callback=self.execution_callback)
 
         # elif feedback.event_type == InteractiveMarkerFeedback.POSE_UPDATE :
         #     if feedback.marker_name in self.manipulator_group_names :
@@ -8,12 +8,17 @@ from geometry_msgs.msg import Pose, PoseStamped
 from visualization_msgs.msg import MarkerArray, Marker
 
 import threading
+import numpy
 import PyKDL as kdl
 
+from collections import OrderedDict
+
 from nasa_robot_teleop.kdl_posemath import *
 from nasa_robot_teleop.urdf_helper import *
 from nasa_robot_teleop.urdf_parser_py import *
 from nasa_robot_teleop.pose_update_thread import *
+from nasa_robot_teleop.marker_helper import MarkerPool
+from nasa_robot_teleop.kinematic_chain import BATCH_JOINT_KERNELS
 
 class EndEffectorHelper :
 
@@ -22,10 +27,14 @@ class EndEffectorHelper :
         self.link_meshes = {}
         self.link_origins = {}
         self.offset_pose_data = {}
-        self.offset_update_thread = {}
+        self.offset_update_thread = None
+        self.frame_tracker = None
         self.links = []
         self.urdf = None
         self.srdf = None
+        self.joint_kernels = {}
+        self.kinematic_orders = {}
+        self.kinematic_arrays = {}
 
         self.control_frame = ""
         self.control_pose = Pose
@@ -36,7 +45,27 @@ class EndEffectorHelper :
         self.root_frame = root_frame
         self.tf_listener = tf_listener
 
-        self.pose_marker_arrays = {}
+        # stored pose name -> MarkerArray, least recently used first
+        self.pose_marker_arrays = OrderedDict()
+        self.pose_marker_cache_size = 16
+        self.pose_marker_lock = threading.Lock()
+        self.prewarm_thread = None
+
+        # optional disk cache of stored pose link transforms, see load_pose_transforms()
+        self.pose_cache = None
+        self.pose_transforms = None
+        self.pose_transform_states = {}
+        self.pose_transform_links = {}
+        self.pose_cache_thread = None
+
+        self.marker_pool = MarkerPool()
+
+        # link motion below these (meters, radians) is treated as sensor noise
+        self.translation_threshold = 0.0005
+        self.rotation_threshold = 0.002
+
+        # ((snapshot version, stamp), link -> frame) of the last snapshot drawn
+        self.snapshot_frames = (None, {})
 
     def add_link(self, link, mesh, origin) :
         self.link_meshes[link] = mesh
@@ -45,54 +74,89 @@ class EndEffectorHelper :
 
     def set_urdf(self, urdf) :
         self.urdf = urdf
+        self.joint_kernels = get_joint_kernels(urdf)
+        self.kinematic_orders = {}
+        self.kinematic_arrays = {}
 
     def set_srdf(self, srdf) :
         self.srdf = srdf
 
-    def get_markers_for_pose(self, pose) :
+    def set_frame_tracker(self, frame_tracker) :
+        self.frame_tracker = frame_tracker
 
-        markers = MarkerArray()
+    def get_markers_for_pose(self, pose) :
 
         # compute current position marker array
         if pose == "current" :
-            markers = self.get_current_position_marker_array(root=self.root_name)
-            return markers
+            return self.get_current_position_marker_array(root=self.root_frame)
 
         # look up stored pose or compute it if it doesnt exist
-        if not pose in self.pose_marker_arrays.keys() :
-            if not self.srdf == None :
-                poses = self.srdf.get_group_state_list(self.name)
-                poses.sort()
-                N = len(poses)
-                color = (0,poses.index(pose)/(N-1,0,1))
-                print "color for pose: ", pose, ": ", color
-                if not pose in poses :
-                    rospy.logerr("EndEffectorHelper::get_markers_for_pose() -- no pose available!!")
-                else :
-                    jpos = self.srdf.get_group_state(self.name, pose).to_joint_state_msg()
-                    self.pose_marker_arrays[pose] = self.get_marker_array_from_joint_position(jpos=jpos, root=self.root_frame, color=color)
-                    markers = self.pose_marker_arrays[pose]
-            else :
-                rospy.logerr("EndEffectorHelper::get_markers_for_pose() -- no SRDF set!!")
+        with self.pose_marker_lock :
+            if pose in self.pose_marker_arrays :
+                # mark as most recently used
+                markers = self.pose_marker_arrays.pop(pose)
+                self.pose_marker_arrays[pose] = markers
+                return markers
+
+        if self.srdf == None :
+            rospy.logerr("EndEffectorHelper::get_markers_for_pose() -- no SRDF set!!")
+            return MarkerArray()
+
+        poses = self.srdf.get_group_state_list(self.name)
+        if not pose in poses :
+            rospy.logerr("EndEffectorHelper::get_markers_for_pose() -- no pose available!!")
+            return MarkerArray()
+
+        jpos = self.srdf.get_group_state(self.name, pose).to_joint_state_msg()
+        links = self.get_joint_position_links(jpos.name, self.root_frame)
+        frames = self.get_cached_pose_frames(pose, links)
+        if frames != None :
+            markers = self.create_marker_array_for_links(links, frames, 1, self.get_pose_color(pose, poses))
         else :
-            markers = self.pose_marker_arrays[pose]
+            markers = self.get_marker_array_from_joint_position(jpos=jpos, root=self.root_frame, color=self.get_pose_color(pose, poses))
+
+        with self.pose_marker_lock :
+            self.pose_marker_arrays[pose] = markers
+            while len(self.pose_marker_arrays) > self.pose_marker_cache_size :
+                self.pose_marker_arrays.popitem(last=False)
 
         return markers
 
+    def get_pose_color(self, pose, poses) :
+        N = len(poses)
+        c = 0.5
+        if N > 1 : c = 0.5+(poses.index(pose)/(N-1.0))/2.0
+        return (0,c,0.67+c/3.0,1)
+
+    def set_pose_marker_cache_size(self, size) :
+        with self.pose_marker_lock :
+            self.pose_marker_cache_size = size
+            while len(self.pose_marker_arrays) > size :
+                self.pose_marker_arrays.popitem(last=False)
+
+    def start_pose_marker_prewarm_thread(self) :
+        if self.srdf == None : return
+        if self.prewarm_thread != None and self.prewarm_thread.is_alive() : return
+        # only warm as many states as the cache can hold
+        poses = self.srdf.get_group_state_list(self.name)[:self.pose_marker_cache_size]
+        self.prewarm_thread = PoseMarkerPrewarmThread(self, poses)
+        self.prewarm_thread.start()
+
+    def stop_pose_marker_prewarm_thread(self) :
+        if self.prewarm_thread != None :
+            self.prewarm_thread.stop()
 
-    def populate_data(self, links, urdf, srdf) :
+    def populate_data(self, links, urdf, srdf, prewarm=False) :
 
         if self.srdf == None : self.set_srdf(srdf)
         if self.urdf == None : self.set_urdf(urdf)
 
-        if not self.srdf == None :
-            poses = self.srdf.get_group_state_list(self.name)
-            N = len(poses)
-            for p in poses :
-                c = 0.5+(poses.index(p)/(N-1.0))/2.0
-                color = (0,c,0.67+c/3.0,1)
-                jpos = self.srdf.get_group_state(self.name, p).to_joint_state_msg()
-                self.pose_marker_arrays[p] = self.get_marker_array_from_joint_position(jpos=jpos, root=self.root_frame, color=color)
+        # stored pose link transforms come from the disk cache when one is set. a cold
+        # cache is filled in the background so startup does not scale with the states
+        if self.pose_cache != None : self.load_pose_transforms()
+
+        # stored pose markers are built on first request, or in the background if asked for
+        if prewarm : self.start_pose_marker_prewarm_thread()
 
         for link in links :
             if not link in self.urdf.link_map :
@@ -105,15 +169,7 @@ class EndEffectorHelper :
                     if model_link.visual.geometry  :
                         if model_link.visual.geometry.filename  :
                             mesh = model_link.visual.geometry.filename
-                            p = geometry_msgs.msg.Pose()
-                            q = (kdl.Rotation.RPY(model_link.visual.origin.rpy[0],model_link.visual.origin.rpy[1],model_link.visual.origin.rpy[2])).GetQuaternion()
-                            p.position.x = model_link.visual.origin.xyz[0]
-                            p.position.y = model_link.visual.origin.xyz[1]
-                            p.position.z = model_link.visual.origin.xyz[2]
-                            p.orientation.x = q[0]
-                            p.orientation.y = q[1]
-                            p.orientation.z = q[2]
-                            p.orientation.w = q[3]
+                            p = toMsg(self.urdf.get_visual_origin_frame(link))
                             self.add_link(link, mesh, p)
 
         self.start_offset_update_thread()
@@ -124,10 +180,29 @@ class EndEffectorHelper :
     def get_links(self) :
         return self.links
 
-    def get_link_data(self, link) :
+    def get_link_data(self, link, snapshot=None) :
         if not self.has_link(link) : return False
-        if not self.offset_update_thread[link].get_pose_data() : return False
-        return (self.link_meshes[link], self.offset_update_thread[link].get_pose_data())
+        if snapshot == None : snapshot = self.get_pose_snapshot()
+        if snapshot == None : return False
+        pose = snapshot.poses.get(link)
+        if pose == None : return False
+        return (self.link_meshes[link], pose)
+
+    def get_snapshot_frames(self, snapshot) :
+        # link -> frame of a snapshot. the frames are only rebuilt when the snapshot
+        # version changes, so ghosts drawn while the hand is still (every waypoint of a
+        # path, and every path planned in the meantime) reuse them. the stamp tells
+        # apart snapshots of a set that was registered again.
+        (version, frames) = self.snapshot_frames
+        if version != (snapshot.version, snapshot.stamp) :
+            frames = dict((link, fromMsg(pose)) for (link, pose) in snapshot.poses.items())
+            self.snapshot_frames = ((snapshot.version, snapshot.stamp), frames)
+        return frames
+
+    def get_pose_snapshot(self) :
+        # consistent set of link poses from a single tf time, or None before the poller starts
+        if self.offset_update_thread == None : return None
+        return self.offset_update_thread.get_snapshot()
 
     def set_control_frame(self, control_pose, control_mesh) :
         self.control_pose = control_pose
@@ -137,19 +212,25 @@ class EndEffectorHelper :
         print "EndEffectorHelper::start_offset_update_thread() -- starting offset update thread for end effector from root: ", self.root_frame
         for link in self.links :
             self.offset_pose_data[link] = PoseStamped()
-            # try :
-            self.offset_update_thread[link] = PoseUpdateThread(link, self.root_frame, link, self.tf_listener, self.link_origins[link])
-            self.offset_update_thread[link].start()
-            # except :
-            #     rospy.logerr("EndEffectorHelper::start_offset_update_thread() -- unable to start end effector link offset update thread")
+        # every link of the end effector is resolved at the same tf time, by the shared
+        # frame tracker if there is one, otherwise by a thread of our own
+        if self.frame_tracker != None :
+            self.offset_update_thread = self.frame_tracker.register_set(self.root_frame, self.link_origins,
+                translation_threshold=self.translation_threshold, rotation_threshold=self.rotation_threshold)
+        else :
+            self.offset_update_thread = MultiPoseUpdateThread(self.name, self.root_frame, self.tf_listener, self.link_origins, rate=10.0, event_driven=True,
+                translation_threshold=self.translation_threshold, rotation_threshold=self.rotation_threshold)
+            self.offset_update_thread.start()
 
     def stop_offset_update_thread(self) :
         print "EndEffectorHelper::stop_offset_update_thread() -- stopping offset update thread for end effector from root: ", self.root_frame
-        for link in self.links :
-            try :
-                self.offset_update_thread[link].stop()
-            except :
-                rospy.logerr("EndEffectorHelper::stop_offset_update_thread() -- unable to stop end effector link offset update thread")
+        try :
+            if self.frame_tracker != None :
+                self.frame_tracker.unregister(self.offset_update_thread)
+            else :
+                self.offset_update_thread.stop()
+        except :
+            rospy.logerr("EndEffectorHelper::stop_offset_update_thread() -- unable to stop end effector link offset update thread")
 
     def get_link_offset(self, link) :
         return self.offset_pose_data[link]
@@ -157,18 +238,35 @@ class EndEffectorHelper :
     def get_root_frame(self) :
         return self.root_frame
 
-    def get_current_position_marker(self, link, offset=None, root="", scale=1, color=(0,1,0,1), idx=0):
-        (mesh, pose) = self.get_link_data(link)
+    def get_current_position_marker(self, link, offset=None, root="", scale=1, color=(0,1,0,1), idx=0, slot=None, snapshot=None):
+        if snapshot == None : snapshot = self.get_pose_snapshot()
+        (mesh, pose) = self.get_link_data(link, snapshot)
 
-        marker = Marker()
+        # with a slot, reuse a pooled marker and only write the per frame fields
+        if slot != None :
+            marker = self.get_pooled_marker(link, mesh, scale, color, slot)
+        else :
+            marker = self.create_link_marker(link, mesh, scale, color)
 
+        T_link = self.get_snapshot_frames(snapshot)[link]
         if offset==None :
-            marker.pose = pose
+            setMsg(marker.pose, T_link)
         else :
-            marker.pose = toMsg(fromMsg(offset)*fromMsg(pose))
+            setMsg(marker.pose, fromMsg(offset)*T_link)
 
         marker.header.frame_id = root
         marker.header.stamp = rospy.get_rostime()
+        marker.id = idx
+        return marker
+
+    def get_pooled_marker(self, link, mesh, scale, color, slot) :
+        key = (link, scale, tuple(color))
+        if not self.marker_pool.has_template(key) :
+            self.marker_pool.add_template(key, self.create_link_marker(link, mesh, scale, color))
+        return self.marker_pool.get_marker(key, slot)
+
+    def create_link_marker(self, link, mesh, scale, color) :
+        marker = Marker()
         marker.ns = self.robot_name
         marker.mesh_resource = mesh
         marker.type = Marker.MESH_RESOURCE
@@ -181,7 +279,6 @@ class EndEffectorHelper :
         marker.color.b = color[2]
         marker.color.a = color[3]
         marker.text = link
-        marker.id = idx
         marker.mesh_use_embedded_materials = True
         return marker
 
@@ -199,17 +296,7 @@ class EndEffectorHelper :
                 if model_link.visual.geometry  :
                     if model_link.visual.geometry.filename  :
                         mesh = model_link.visual.geometry.filename
-                        p = geometry_msgs.msg.Pose()
-                        q = (kdl.Rotation.RPY(model_link.visual.origin.rpy[0],model_link.visual.origin.rpy[1],model_link.visual.origin.rpy[2])).GetQuaternion()
-                        p.position.x = model_link.visual.origin.xyz[0]
-                        p.position.y = model_link.visual.origin.xyz[1]
-                        p.position.z = model_link.visual.origin.xyz[2]
-                        p.orientation.x = q[0]
-                        p.orientation.y = q[1]
-                        p.orientation.z = q[2]
-                        p.orientation.w = q[3]
-
-                        marker.pose = toMsg(T*fromMsg(p))
+                        marker.pose = toMsg(T*self.urdf.get_visual_origin_frame(link))
 
                         marker.header.frame_id = self.root_frame
                         marker.ns = self.robot_name
@@ -231,96 +318,285 @@ class EndEffectorHelper :
 
 
 
-    def get_current_position_marker_array(self, offset=None, root="", scale=1, color=(0,1,0,1), idx=0) :
+    def get_current_position_marker_array(self, offset=None, root="", scale=1, color=(0,1,0,1), idx=0, slot=None, snapshot=None) :
 
         markers = MarkerArray()
         if root=="": root = self.root_frame
 
+        # every link comes from the same snapshot, so the hand never tears
+        if snapshot == None : snapshot = self.get_pose_snapshot()
+        if snapshot == None : return markers
+
         for link in self.get_links() :
-            if self.get_link_data(link) :
-                marker = self.get_current_position_marker(link, offset, root, scale, color, idx)
+            if self.get_link_data(link, snapshot) :
+                marker = self.get_current_position_marker(link, offset, root, scale, color, idx, slot, snapshot)
                 markers.markers.append(marker)
                 idx += 1
 
         self.current_marker_array = markers
         return markers
 
-    def get_marker_array_from_joint_position(self, jpos, offset=None, root="", scale=1, color=(0,1,1,1), idx=0) :
-
-        # print "EndEffectorHelper::get_marker_array_from_joint_position()"
+    def get_kinematic_order(self, root) :
+        # breadth first order of the URDF subtree below root as (link, parent index, joint)
+        # entries, so every link comes after its parent. computed once per root.
+        if not root in self.kinematic_orders :
+            order = [(root, -1, None)]
+            index = {root : 0}
+            i = 0
+            while i < len(order) :
+                link = order[i][0]
+                if link in self.urdf.child_map :
+                    for (joint, child) in self.urdf.child_map[link] :
+                        index[child] = len(order)
+                        order.append((child, i, joint))
+                i += 1
+            self.kinematic_orders[root] = (order, index)
+        return self.kinematic_orders[root]
 
-        markers = MarkerArray()
+    def get_marker_array_from_joint_position(self, jpos, offset=None, root="", scale=1, color=(0,1,1,1), idx=0) :
         if root=="": root = self.root_frame
+        (order, index) = self.get_kinematic_order(root)
+        T_link = self.get_link_frames_from_joint_position(jpos, root)
+        links = self.get_joint_position_links(jpos.name, root)
+        return self.create_marker_array_for_links(links, [T_link[index[link]] for link in links], scale, color)
 
+    def get_joint_position_links(self, joint_names, root) :
+        # the mesh links rendered for a joint position: links driven by the joints, plus the root
         link_list = []
-        link_joints = {}
-        T_joint = {}
-        T_link = {}
-
-        for j in jpos.name :
-            link = self.urdf.link_map[self.urdf.joint_map[j].child].name
-            if not link in link_joints.keys(): link_joints[link] = j
+        for j in joint_names :
+            link = self.urdf.joint_map[j].child
             if not link in link_list : link_list.append(link)
+        if not root in link_list : link_list.append(root)
 
-            model_joint = self.urdf.joint_map[j]
-            joint_val = jpos.position[jpos.name.index(j)]
-            T_joint[j] = get_joint_rotation(model_joint.axis, joint_val)
-
-        if not root in link_list :
-            link_list.append(root)
-            link_joints[root] = get_link_joint(root, self.urdf)
-        # print link_list
-
-        def get_transform_to_link(root_frame, link, joint, T_link) :
-
-            # print "Getting transform of link: ", link, " with joint: ", joint
-            # print "root_frame:", root_frame
-            # already is in list
-            if link in T_link.keys() :
-                # print "Already found Transform for link: ", link
-                return T_link[link]
-
-            # check first link
-            # if link == root_frame :
-            #     print "At base Transform: ", root_frame
-            #     return kdl.Frame()
-
-            if not self.urdf.joint_map[joint].type == "fixed":
-                if not joint in jpos.name :
-                    # print "\n------\nFound joint ", joint, " for link: ", link, " but it is not in the jpos list, looking up frame and exiting.."
-                    self.tf_listener.waitForTransform(root_frame, link, rospy.Time(0), rospy.Duration(5.0))
-                    (trans, rot) = self.tf_listener.lookupTransform(root_frame, link, rospy.Time(0))
-                    rot = normalize_vector(rot)
-                    T = fromMsg(toPose(trans,rot)).Inverse()
-                    # print T
-                    return kdl.Frame()
-
-            # call recursive function to parent, then add link transform, then add joint transform
-            parent = get_parent_link(link, self.urdf)
-            parent_joint = get_link_joint(parent, self.urdf)
-            #rint "\tNeed to go to parent link: ", parent, " with joint: ", parent_joint
-            T = get_transform_to_link(root_frame, parent, parent_joint, T_link)
-
-            model_joint = self.urdf.joint_map[joint]
-            T_kin = fromMsg(joint_origin_to_pose(model_joint))
-            # print "Link: ", link, " -- computing tf for joint: ", joint, "between ", self.urdf.joint_map[joint].parent , "<-->", self.urdf.joint_map[joint].child
-            # # print T_kin
-
-            if joint in T_joint.keys() :
-                T_link[link] = T*T_kin*T_joint[joint]
+        (order, index) = self.get_kinematic_order(root)
+        links = []
+        for link in link_list :
+            if not link in index :
+                rospy.logwarn("EndEffectorHelper::get_joint_position_links() -- link: " + link + " is not below " + root)
+                continue
+            if link_has_mesh(self.urdf.link_map[link]) :
+                links.append(link)
+        return links
+
+    def get_link_frames_from_joint_position(self, jpos, root) :
+        # frames of every link below root (in get_kinematic_order() order) for jpos
+        (order, index) = self.get_kinematic_order(root)
+        positions = dict(zip(jpos.name, jpos.position))
+
+        # single forward pass, every parent frame is already computed by the time
+        # its children are reached
+        T_link = [kdl.Frame()]
+        for (link, parent, joint) in order[1:] :
+            T = T_link[parent]*self.urdf.get_joint_origin_frame(joint)
+            if joint in positions and self.joint_kernels[joint] :
+                T = T*self.joint_kernels[joint](positions[joint])
+            T_link.append(T)
+        return T_link
+
+    def get_kinematic_arrays(self, root) :
+        # numpy form of get_kinematic_order(root) for batch FK: parent indices, joint
+        # origin matrices, joint axes and batch kernels. computed once per root.
+        if not root in self.kinematic_arrays :
+            (order, index) = self.get_kinematic_order(root)
+            parents = [-1]
+            origins = [numpy.identity(4)]
+            axes = [None]
+            kernels = [None]
+            for (link, parent, joint) in order[1:] :
+                model_joint = self.urdf.joint_map[joint]
+                parents.append(parent)
+                origins.append(toMatrix(self.urdf.get_joint_origin_frame(joint)))
+                axes.append(get_joint_axis(model_joint))
+                kernels.append(BATCH_JOINT_KERNELS.get(model_joint.type))
+            self.kinematic_arrays[root] = (parents, origins, axes, kernels)
+        return self.kinematic_arrays[root]
+
+    def get_link_transforms_from_joint_positions(self, names, positions, root="", T_base=None) :
+        # batch FK over an (N x J) array of joint positions ordered as names. T_base is
+        # an optional (4 x 4) or (N x 4 x 4) transform of the root. returns the
+        # (N x K x 4 x 4) transforms of every link below root, in get_kinematic_order() order
+        if root=="": root = self.root_frame
+        positions = numpy.array(positions, dtype=float, ndmin=2)
+        N = positions.shape[0]
+        (parents, origins, axes, kernels) = self.get_kinematic_arrays(root)
+        columns = dict((n,i) for (i,n) in enumerate(names))
+        (order, index) = self.get_kinematic_order(root)
+
+        T_link = numpy.zeros((N,len(order),4,4))
+        if T_base is None :
+            T_link[:,0] = numpy.identity(4)
+        else :
+            T_link[:,0] = T_base
+        for i in range(1, len(order)) :
+            T = numpy.einsum('nij,jk->nik', T_link[:,parents[i]], origins[i])
+            joint = order[i][2]
+            if joint in columns and kernels[i] :
+                T = numpy.einsum('nij,njk->nik', T, kernels[i](axes[i], positions[:,columns[joint]]))
+            T_link[:,i] = T
+        return T_link
+
+    def get_marker_array_from_joint_positions(self, names, positions, offsets=None, root="", scale=1, color=(0,1,1,1), idx=0, slot_offset=None) :
+        # markers for N hand configurations at once. offsets are optional per configuration
+        # root poses (a list of Pose, or an (N x 4 x 4) array). marker ids are
+        # idx + n*L + l for link l of configuration n, L being the number of rendered links.
+        # with a slot_offset, configuration n reuses pooled markers from slot slot_offset+n.
+        if root=="": root = self.root_frame
+        T_base = None
+        if offsets is not None :
+            if isinstance(offsets, numpy.ndarray) :
+                T_base = offsets
             else :
-                T_link[link] = T*T_kin
-            return T_link[link]
+                T_base = numpy.array([toMatrix(fromMsg(p)) for p in offsets])
 
-        idx = 0
-        for link in link_list :
-            T_link[link] = get_transform_to_link(root, link, link_joints[link], T_link)
-            # print "\n---------\n----------Found Transform to link: ", link
-            # print T_link[link]
+        (order, index) = self.get_kinematic_order(root)
+        links = self.get_joint_position_links(names, root)
+        T_link = self.get_link_transforms_from_joint_positions(names, positions, root, T_base)
 
-            if link_has_mesh(self.urdf.link_map[link]) :
-                markers.markers.append(self.create_marker_for_link(link, T_link[link], scale=scale, color=color, idx=idx))
-                idx += 1
+        meshes = [self.urdf.link_map[link].visual.geometry.filename for link in links]
+        T_viz = [numpy.einsum('nij,jk->nik', T_link[:,index[link]], toMatrix(self.urdf.get_visual_origin_frame(link))) for link in links]
 
+        markers = MarkerArray()
+        stamp = rospy.get_rostime()
+        for n in range(len(T_link)) :
+            for l in range(len(links)) :
+                if slot_offset != None :
+                    marker = self.get_pooled_marker(links[l], meshes[l], scale, color, slot_offset+n)
+                else :
+                    marker = self.create_link_marker(links[l], meshes[l], scale, color)
+                setMsgFromMatrix(marker.pose, T_viz[l][n])
+                marker.header.frame_id = root
+                marker.header.stamp = stamp
+                marker.id = idx + n*len(links) + l
+                markers.markers.append(marker)
+
+        return markers
+
+    def create_marker_array_for_links(self, links, frames, scale, color) :
+        markers = MarkerArray()
+        idx = 0
+        for (link, T) in zip(links, frames) :
+            markers.markers.append(self.create_marker_for_link(link, T, scale=scale, color=color, idx=idx))
+            idx += 1
         return markers
 
+    def set_pose_cache(self, pose_cache) :
+        self.pose_cache = pose_cache
+
+    def get_pose_cache_key(self) :
+        urdf_xml = getattr(self.urdf, "xml_string", None)
+        if urdf_xml == None or self.srdf == None or self.srdf.srdf == None : return None
+        return self.pose_cache.get_key(urdf_xml, self.srdf.srdf, self.name)
+
+    def load_pose_transforms(self) :
+        # load the stored pose link transforms from the disk cache. on a miss the entry is
+        # built and saved in the background, and stored poses fall back to FK until then
+        key = self.get_pose_cache_key()
+        if key == None :
+            rospy.logwarn("EndEffectorHelper::load_pose_transforms() -- no model source to key the pose cache on")
+            return False
+
+        entry = self.pose_cache.load(key)
+        if entry == None :
+            print "EndEffectorHelper::load_pose_transforms() -- building pose cache for end effector: ", self.name
+            if self.pose_cache_thread == None or not self.pose_cache_thread.is_alive() :
+                self.pose_cache_thread = PoseCacheBuildThread(self, key)
+                self.pose_cache_thread.start()
+            return False
+
+        (states, links, transforms) = entry
+        self.set_pose_transforms(states, links, transforms)
+        return True
+
+    def get_pose_transform_links(self) :
+        # the links stored per state in the disk cache: every mesh link below the root
+        (order, index) = self.get_kinematic_order(self.root_frame)
+        return [link for (link, parent, joint) in order if link_has_mesh(self.urdf.link_map[link])]
+
+    def compute_pose_transforms(self, state, links) :
+        # (L x 4 x 4) transforms of links for a stored pose
+        (order, index) = self.get_kinematic_order(self.root_frame)
+        jpos = self.srdf.get_group_state(self.name, state).to_joint_state_msg()
+        T_link = self.get_link_frames_from_joint_position(jpos, self.root_frame)
+        return numpy.array([toMatrix(T_link[index[link]]) for link in links])
+
+    def set_pose_transforms(self, states, links, transforms) :
+        # transforms goes in last, get_cached_pose_frames() only reads the indices once it is set
+        self.pose_transform_states = dict((state, s) for (s, state) in enumerate(states))
+        self.pose_transform_links = dict((link, l) for (l, link) in enumerate(links))
+        self.pose_transforms = transforms
+
+    def get_cached_pose_frames(self, pose, links) :
+        # frames of links for a stored pose from the disk cache, or None if not cached
+        if self.pose_transforms is None or not pose in self.pose_transform_states : return None
+        row = self.pose_transforms[self.pose_transform_states[pose]]
+        frames = []
+        for link in links :
+            if not link in self.pose_transform_links : return None
+            frames.append(fromMatrix(row[self.pose_transform_links[link]]))
+        return frames
+
+
+class PoseCacheBuildThread(threading.Thread) :
+    # computes the stored pose link transforms of an end effector that missed the disk
+    # cache one state at a time, then saves the entry and hands it to the helper
+    def __init__(self, helper, key, delay=0.01) :
+        super(PoseCacheBuildThread,self).__init__()
+        self.helper = helper
+        self.key = key
+        self.delay = delay
+        self.running = True
+
+    def run(self) :
+        cache = self.helper.pose_cache
+        # another helper of the same end effector may be building the entry already,
+        # then wait for it and load its result instead of computing it twice
+        if not cache.begin_build(self.key) :
+            while self.running and not rospy.is_shutdown() :
+                if cache.wait_for_build(self.key, 0.5) : break
+            entry = cache.load(self.key)
+            if entry != None : self.helper.set_pose_transforms(*entry)
+            return
+        try :
+            self.build()
+        finally :
+            cache.end_build(self.key)
+
+    def build(self) :
+        links = self.helper.get_pose_transform_links()
+        states = self.helper.srdf.get_group_state_list(self.helper.name)
+        transforms = numpy.zeros((len(states),len(links),4,4))
+        for (s, state) in enumerate(states) :
+            if not self.running or rospy.is_shutdown() : return
+            transforms[s] = self.helper.compute_pose_transforms(state, links)
+            try :
+                rospy.sleep(self.delay)
+            except rospy.ROSInterruptException :
+                return
+        self.helper.pose_cache.save(self.key, states, links, transforms)
+        self.helper.set_pose_transforms(states, links, transforms)
+
+    def stop(self) :
+        self.running = False
+
+
+class PoseMarkerPrewarmThread(threading.Thread) :
+    # fills the stored pose marker cache of an end effector one state at a time,
+    # yielding between states so it stays out of the way of the interactive threads
+    def __init__(self, helper, poses, delay=0.05) :
+        super(PoseMarkerPrewarmThread,self).__init__()
+        self.helper = helper
+        self.poses = list(poses)
+        self.delay = delay
+        self.running = True
+
+    def run(self) :
+        for pose in self.poses :
+            if not self.running or rospy.is_shutdown() : break
+            self.helper.get_markers_for_pose(pose)
+            try :
+                rospy.sleep(self.delay)
+            except rospy.ROSInterruptException :
+                return
+
+    def stop(self) :
+        self.running = False
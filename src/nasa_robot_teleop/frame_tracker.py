@@ -0,0 +1,384 @@
+#! /usr/bin/env python
+
+import rospy
+import roslib
+
+import threading
+import collections
+import time
+import numpy
+import geometry_msgs.msg
+import tf
+import PyKDL as kdl
+
+from nasa_robot_teleop.kdl_posemath import *
+
+TF_EXCEPTIONS = (tf.Exception, tf.LookupException, tf.ConnectivityException, tf.ExtrapolationException)
+
+# an immutable set of frame poses (frame -> Pose) resolved at the same tf time. version
+# increases by one per published snapshot and stamp is that tf time. the poses must be
+# treated as read only.
+PoseSnapshot = collections.namedtuple('PoseSnapshot', ['version', 'stamp', 'poses'])
+
+
+class TfChangeNotifier :
+    # wakes a waiting tracker when the transform of one of its (root, target) chains
+    # differs from the last one seen. the chains are checked against the tf listener's
+    # buffer every period seconds, so nothing subscribes to /tf a second time and tf
+    # republishing unchanged transforms (robot_state_publisher does so at a fixed rate)
+    # never wakes the tracker.
+    def __init__(self, tf_listener, chains=[], period=0.1) :
+        self.tf_listener = tf_listener
+        self.period = period
+        self.chains = list(chains)
+        self.transforms = {}
+        self.mutex = threading.Lock()
+        self.event = threading.Event()
+
+    def set_chains(self, chains) :
+        with self.mutex :
+            self.chains = list(chains)
+            self.transforms = {}
+
+    def add_chain(self, root_frame, target_frame) :
+        with self.mutex :
+            self.chains.append((root_frame, target_frame))
+
+    def changed(self) :
+        # True if any chain transform differs from the one seen by the last call
+        with self.mutex :
+            chains = list(self.chains)
+        changed = False
+        for chain in chains :
+            try :
+                transform = self.tf_listener.lookupTransform(chain[0], chain[1], rospy.Time(0))
+            except TF_EXCEPTIONS :
+                continue
+            with self.mutex :
+                if self.transforms.get(chain) != transform :
+                    self.transforms[chain] = transform
+                    changed = True
+        return changed
+
+    def wait(self, timeout) :
+        # returns True if a chain changed (or notify() was called), False if timeout expired
+        deadline = time.time() + timeout
+        while True :
+            if self.event.is_set() :
+                self.event.clear()
+                return True
+            if self.changed() : return True
+            remaining = deadline - time.time()
+            if remaining <= 0 or rospy.is_shutdown() : return False
+            self.event.wait(min(self.period, remaining))
+
+    def notify(self) :
+        self.event.set()
+
+    def close(self) :
+        self.event.set()
+
+
+class PoseHistory :
+    # fixed size, array backed ring buffer of timestamped poses. get_pose_at() interpolates
+    # between the two samples around a time (lerp for position, slerp for orientation).
+    def __init__(self, capacity=100) :
+        self.capacity = capacity
+        self.times = numpy.zeros(capacity)
+        self.positions = numpy.zeros((capacity,3))
+        self.orientations = numpy.zeros((capacity,4))
+        self.head = 0
+        self.count = 0
+        self.mutex = threading.Lock()
+
+    def append(self, stamp, pose) :
+        t = to_seconds(stamp)
+        with self.mutex :
+            # tf may hand back the same sample more than once, keep time strictly increasing
+            if self.count > 0 and t <= self.times[(self.head-1) % self.capacity] : return
+            self.times[self.head] = t
+            self.positions[self.head] = (pose.position.x, pose.position.y, pose.position.z)
+            self.orientations[self.head] = (pose.orientation.x, pose.orientation.y, pose.orientation.z, pose.orientation.w)
+            self.head = (self.head+1) % self.capacity
+            self.count = min(self.count+1, self.capacity)
+
+    def get_samples(self) :
+        # copies of the (times, positions, orientations) arrays, oldest sample first
+        with self.mutex :
+            order = (numpy.arange(self.count) + self.head - self.count) % self.capacity
+            return (self.times[order], self.positions[order], self.orientations[order])
+
+    def get_window(self) :
+        # (oldest, newest) sample times in seconds, or None if empty
+        (times, positions, orientations) = self.get_samples()
+        if len(times) == 0 : return None
+        return (times[0], times[-1])
+
+    def get_pose_at(self, stamp) :
+        # interpolated pose at stamp (rospy.Time or seconds), or None if outside the window
+        t = to_seconds(stamp)
+        (times, positions, orientations) = self.get_samples()
+        if len(times) == 0 or t < times[0] or t > times[-1] : return None
+        i = int(numpy.searchsorted(times, t))
+        if times[i] == t :
+            return make_pose(positions[i], orientations[i])
+        f = (t - times[i-1])/(times[i] - times[i-1])
+        p = positions[i-1] + f*(positions[i] - positions[i-1])
+        q = transformations.quaternion_slerp(orientations[i-1], orientations[i], f)
+        return make_pose(p, q)
+
+def frame_changed(T_old, T_new, translation_threshold, rotation_threshold) :
+    # True if T_new moved more than the thresholds (meters, radians) away from T_old
+    if T_old is None : return True
+    if (T_new.p - T_old.p).Norm() > translation_threshold : return True
+    return (T_old.M.Inverse()*T_new.M).GetRotAngle()[0] > rotation_threshold
+
+def run_callback(callback, arg, owner, frame) :
+    # callbacks run on the shared tracker thread, so one failing must not stop it
+    try :
+        callback(arg)
+    except Exception as e :
+        rospy.logerr(str(owner + "::run_callback() -- callback for " + frame + " failed: " + str(e)))
+
+def to_seconds(stamp) :
+    if hasattr(stamp, "to_sec") : return stamp.to_sec()
+    return float(stamp)
+
+def make_pose(p, q) :
+    pose = geometry_msgs.msg.Pose()
+    (pose.position.x, pose.position.y, pose.position.z) = p
+    (pose.orientation.x, pose.orientation.y, pose.orientation.z, pose.orientation.w) = q
+    return pose
+
+
+class TrackedFrame :
+    # the pose of target_frame in root_frame (times an optional offset) as last seen by
+    # the tracker evaluating it. is_valid is set by each update and cleared by
+    # get_pose_data(), so a reader can tell when a newer pose has arrived. the last
+    # history_size poses are kept with their tf time for get_pose_at().
+    # a pose only counts as new (bumping version, setting is_valid and firing callbacks)
+    # when it moved more than translation_threshold meters or rotation_threshold radians
+    # from the last one published, so a stationary frame produces no work downstream.
+    def __init__(self, root_frame, target_frame, offset_pose=None, tracker=None, history_size=100, translation_threshold=0.0, rotation_threshold=0.0) :
+        self.root_frame = root_frame
+        self.target_frame = target_frame
+        self.tracker = tracker
+        self.T_offset = kdl.Frame()
+        if offset_pose != None :
+            self.T_offset = fromMsg(offset_pose)
+        self.pose_data = geometry_msgs.msg.Pose()
+        self.stamp = None
+        self.is_valid = False
+        self.callbacks = []
+        self.history = PoseHistory(history_size)
+        self.translation_threshold = translation_threshold
+        self.rotation_threshold = rotation_threshold
+        self.T_published = None
+        self.version = 0
+        # update count (changed or not), guarded by condition so readers can wait for the next pose
+        self.sequence = 0
+        self.condition = threading.Condition()
+
+    def get_targets(self) :
+        return [self.target_frame]
+
+    def add_callback(self, callback) :
+        # callback(tracked_frame) runs on the tracker thread after every change
+        self.callbacks.append(callback)
+
+    def get_version(self) :
+        return self.version
+
+    def lookup(self, tf_listener, stamp) :
+        try :
+            # stamp the pose with the time of the tf data, not the time of the tick
+            stamp = tf_listener.getLatestCommonTime(self.root_frame, self.target_frame)
+            (trans, rot) = tf_listener.lookupTransform(self.root_frame, self.target_frame, stamp)
+        except TF_EXCEPTIONS :
+            rospy.logdebug("TrackedFrame::lookup() -- could not update " + self.target_frame)
+            return False
+        self.update(fromMsg(toPose(trans, rot)), stamp)
+        return True
+
+    def update(self, T, stamp) :
+        T = T*self.T_offset
+        self.stamp = stamp
+        changed = frame_changed(self.T_published, T, self.translation_threshold, self.rotation_threshold)
+        if changed :
+            self.T_published = T
+            self.pose_data = toMsg(T)
+            self.version += 1
+            self.is_valid = True
+        self.history.append(stamp, toMsg(T))
+        with self.condition :
+            self.sequence += 1
+            self.condition.notify_all()
+        if changed :
+            for callback in self.callbacks :
+                run_callback(callback, self, "TrackedFrame", self.target_frame)
+
+    def get_pose_data(self) :
+        self.is_valid = False
+        # the caller wants a fresh pose next, so don't make it wait for the next tf change
+        if self.tracker != None : self.tracker.request_update()
+        return self.pose_data
+
+    def wait_for_next_pose(self, timeout) :
+        # blocks until the tracker produces a pose newer than the call, then returns it
+        # like get_pose_data(). returns None if none arrives within timeout seconds.
+        deadline = time.time() + timeout
+        with self.condition :
+            sequence = self.sequence
+            if self.tracker != None : self.tracker.request_update()
+            while self.sequence == sequence :
+                remaining = deadline - time.time()
+                if remaining <= 0 or rospy.is_shutdown() : return None
+                self.condition.wait(remaining)
+        return self.get_pose_data()
+
+    def get_pose_at(self, stamp) :
+        return self.history.get_pose_at(stamp)
+
+    def get_history(self) :
+        return self.history
+
+
+class TrackedFrameSet :
+    # a set of target frames resolved against the same root at one common tf time and
+    # published together as a PoseSnapshot. the snapshot is double buffered: each tick
+    # fills a fresh one and installs it with a single reference swap, so readers never
+    # lock and a snapshot they hold is never modified. a new snapshot (and version) is
+    # only published when some frame moved past the thresholds, see TrackedFrame.
+    def __init__(self, root_frame, offset_poses, tracker=None, translation_threshold=0.0, rotation_threshold=0.0) :
+        self.root_frame = root_frame
+        self.tracker = tracker
+        self.frames = offset_poses.keys()
+        self.T_offsets = {}
+        for frame in self.frames :
+            self.T_offsets[frame] = kdl.Frame()
+            if offset_poses[frame] != None :
+                self.T_offsets[frame] = fromMsg(offset_poses[frame])
+        self.snapshot = PoseSnapshot(0, None, {})
+        self.callbacks = []
+        self.translation_threshold = translation_threshold
+        self.rotation_threshold = rotation_threshold
+        self.T_published = {}
+
+    def get_targets(self) :
+        return self.frames
+
+    def add_callback(self, callback) :
+        # callback(snapshot) runs on the tracker thread after every change
+        self.callbacks.append(callback)
+
+    def get_version(self) :
+        return self.snapshot.version
+
+    def lookup(self, tf_listener, stamp) :
+        if len(self.frames) == 0 : return True
+        try :
+            # resolve every frame at the newest time tf knows all of them at, so a snapshot
+            # never mixes links from different tf instants. if any frame is missing the
+            # whole tick is skipped rather than keeping an older pose for it.
+            stamp = min([tf_listener.getLatestCommonTime(self.root_frame, frame) for frame in self.frames])
+            transforms = [tf_listener.lookupTransform(self.root_frame, frame, stamp) for frame in self.frames]
+        except TF_EXCEPTIONS :
+            rospy.logdebug("TrackedFrameSet::lookup() -- could not resolve every frame in " + self.root_frame)
+            return False
+        front = self.snapshot
+        poses = dict(front.poses)
+        changed = False
+        for (frame, (trans, rot)) in zip(self.frames, transforms) :
+            T = fromMsg(toPose(trans, rot))*self.T_offsets[frame]
+            if frame_changed(self.T_published.get(frame), T, self.translation_threshold, self.rotation_threshold) :
+                self.T_published[frame] = T
+                poses[frame] = toMsg(T)
+                changed = True
+        if not changed : return True
+        self.snapshot = PoseSnapshot(front.version+1, stamp, poses)
+        for callback in self.callbacks :
+            run_callback(callback, self.snapshot, "TrackedFrameSet", self.root_frame)
+        return True
+
+    def get_pose_data(self, frame) :
+        return self.snapshot.poses.get(frame)
+
+    def get_snapshot(self) :
+        return self.snapshot
+
+
+class FrameTracker(threading.Thread) :
+    # one thread that evaluates every registered (root, target, offset) query at a shared
+    # tick. with event_driven set, a tick happens when the transform of a registered
+    # chain changes value (or staleness_timeout passes), so a still robot leaves the
+    # tracker idle. otherwise it ticks at a fixed rate. either way there are at most
+    # rate ticks a second. results are read from the returned
+    # TrackedFrame / TrackedFrameSet handles or delivered to their callbacks.
+    def __init__(self, tf_listener, rate=10.0, event_driven=True, staleness_timeout=1.0, name="frame_tracker") :
+        super(FrameTracker,self).__init__()
+        self.name = name
+        self.tf_listener = tf_listener
+        self.period = 1.0/rate
+        self.event_driven = event_driven
+        self.staleness_timeout = staleness_timeout
+        self.queries = []
+        self.mutex = threading.Lock()
+        self.notifier = None
+        if self.event_driven :
+            self.notifier = TfChangeNotifier(self.tf_listener, period=self.period)
+        self.running = True
+
+    def register(self, root_frame, target_frame, offset_pose=None, callback=None, history_size=100, translation_threshold=0.0, rotation_threshold=0.0) :
+        query = TrackedFrame(root_frame, target_frame, offset_pose, self, history_size, translation_threshold, rotation_threshold)
+        if callback != None : query.add_callback(callback)
+        self.add_query(query)
+        return query
+
+    def register_set(self, root_frame, offset_poses, callback=None, translation_threshold=0.0, rotation_threshold=0.0) :
+        query = TrackedFrameSet(root_frame, offset_poses, self, translation_threshold, rotation_threshold)
+        if callback != None : query.add_callback(callback)
+        self.add_query(query)
+        return query
+
+    def add_query(self, query) :
+        with self.mutex :
+            self.queries.append(query)
+            if self.notifier != None :
+                for target in query.get_targets() :
+                    self.notifier.add_chain(query.root_frame, target)
+        self.request_update()
+
+    def unregister(self, query) :
+        with self.mutex :
+            if query in self.queries :
+                self.queries.remove(query)
+            if self.notifier != None :
+                self.notifier.set_chains([(q.root_frame, t) for q in self.queries for t in q.get_targets()])
+
+    def request_update(self) :
+        if self.notifier != None : self.notifier.notify()
+
+    def run(self) :
+        while self.running and not rospy.is_shutdown() :
+            if self.event_driven :
+                self.notifier.wait(self.staleness_timeout)
+                if not self.running : break
+            with self.mutex :
+                queries = list(self.queries)
+            stamp = rospy.get_rostime()
+            for query in queries :
+                # every group shares this thread, so a failing query must not stop the others
+                try :
+                    query.lookup(self.tf_listener, stamp)
+                except Exception as e :
+                    rospy.logerr(str("FrameTracker::run() -- update of " + str(query.get_targets()) + " in " + query.root_frame + " failed: " + str(e)))
+            try :
+                rospy.sleep(self.period)
+            except rospy.ROSInterruptException :
+                break
+        if self.notifier != None : self.notifier.close()
+        print "Killing Frame Tracker: ", self.name
+
+    def stop(self) :
+        self.running = False
+        self.request_update()
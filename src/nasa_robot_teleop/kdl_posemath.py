@@ -100,6 +100,25 @@ def toMsg(f):
     # p.orientation.x, p.orientation.y, p.orientation.z, p.orientation.w = f.M.GetQuaternion()
     return p
 
+def setMsg(p, f):
+    """
+    :param p: output pose
+    :type p: :class:`geometry_msgs.msg.Pose`
+    :param f: input pose
+    :type f: :class:`PyKDL.Frame`
+
+    Write the Frame f into an existing ROS Pose message, so the message can be reused.
+    """
+    p.position.x = f.p[0]
+    p.position.y = f.p[1]
+    p.position.z = f.p[2]
+    q = normalize_vector(f.M.GetQuaternion())
+    p.orientation.x = q[0]
+    p.orientation.y = q[1]
+    p.orientation.z = q[2]
+    p.orientation.w = q[3]
+    return p
+
 
 # to and from matrix
 def fromMatrix(m):
@@ -129,6 +148,27 @@ def toMatrix(f):
                         [0,0,0,1]])
 
 
+def setMsgFromMatrix(p, m):
+    """
+    :param p: output pose
+    :type p: :class:`geometry_msgs.msg.Pose`
+    :param m: input 4x4 matrix
+    :type m: :func:`numpy.array`
+
+    Write a pose represented as a 4x4 numpy array into an existing ROS Pose message.
+    """
+    p.position.x = m[0,3]
+    p.position.y = m[1,3]
+    p.position.z = m[2,3]
+    q = transformations.quaternion_from_matrix(m)
+    q = q/numpy.sqrt(numpy.dot(q,q))
+    p.orientation.x = q[0]
+    p.orientation.y = q[1]
+    p.orientation.z = q[2]
+    p.orientation.w = q[3]
+    return p
+
+
 def toPose(x, q) :
     """
     :param x: input position
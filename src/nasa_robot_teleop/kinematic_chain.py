@@ -0,0 +1,175 @@
+#! /usr/bin/env python
+
+import rospy
+import numpy
+import PyKDL as kdl
+
+from nasa_robot_teleop.kdl_posemath import *
+from nasa_robot_teleop.urdf_helper import *
+
+def axis_rotation_matrices(axis, q) :
+    # stack of homogeneous rotations about a unit axis, one per entry in q
+    (x, y, z) = axis
+    c = numpy.cos(q)
+    s = numpy.sin(q)
+    v = 1.0 - c
+    T = numpy.zeros((len(q),4,4))
+    T[:,0,0] = x*x*v + c
+    T[:,0,1] = x*y*v - z*s
+    T[:,0,2] = x*z*v + y*s
+    T[:,1,0] = y*x*v + z*s
+    T[:,1,1] = y*y*v + c
+    T[:,1,2] = y*z*v - x*s
+    T[:,2,0] = z*x*v - y*s
+    T[:,2,1] = z*y*v + x*s
+    T[:,2,2] = z*z*v + c
+    T[:,3,3] = 1.0
+    return T
+
+def axis_translation_matrices(axis, q) :
+    # stack of homogeneous translations along a unit axis, one per entry in q
+    T = numpy.zeros((len(q),4,4))
+    T[:,0,0] = T[:,1,1] = T[:,2,2] = T[:,3,3] = 1.0
+    T[:,0,3] = axis[0]*q
+    T[:,1,3] = axis[1]*q
+    T[:,2,3] = axis[2]*q
+    return T
+
+BATCH_JOINT_KERNELS = {
+    'revolute' : axis_rotation_matrices,
+    'continuous' : axis_rotation_matrices,
+    'prismatic' : axis_translation_matrices,
+}
+
+class KinematicChain :
+
+    def __init__(self, urdf, joint_names) :
+
+        self.urdf = urdf
+        # SRDF groups can name joints the URDF doesn't have (virtual or floating joints of a
+        # full body group). they can't be previewed, but must not stop the group loading
+        self.joint_names = []
+        for j in joint_names :
+            if j in self.urdf.joint_map :
+                self.joint_names.append(j)
+            else :
+                rospy.logwarn(str("KinematicChain::__init__() -- joint " + j + " is not in the URDF, leaving it out of the preview"))
+
+        # compiled tree data for batch FK, one entry per moving URDF joint between the base
+        # and the group's joints, parents before children. joint_parents holds the index of
+        # the entry each joint hangs off (-1 for the base), so branching groups (both arms,
+        # a full body) keep every branch. fixed joints are folded into the static origin
+        # of the next moving joint, or into the visual offsets of the links below it.
+        self.joints = []
+        self.joint_parents = []
+        self.mesh_links = []
+        self.tip_index = -1
+        self.joint_axes = []
+        self.batch_kernels = []
+        self.origin_matrices = []
+        self.visual_matrices = []
+        self.tip_offset_matrix = numpy.identity(4)
+
+        # cached joint_trajectory.joint_names -> tree index permutations
+        self.permutations = {}
+
+        self.base_link = ""
+        self.tip_link = ""
+
+        self.compile()
+
+    def compile(self) :
+
+        if len(self.joint_names) == 0 : return
+
+        # the base is the lowest link above every joint of the group, the tip is the
+        # child of the deepest joint
+        ordered = sorted(self.joint_names, key=lambda j: self.get_joint_depth(j))
+        self.base_link = self.urdf.joint_map[ordered[0]].parent
+        for j in ordered[1:] :
+            base = self.urdf.get_common_ancestor(self.base_link, self.urdf.joint_map[j].parent)
+            if base == None :
+                print "KinematicChain::compile() -- joint ", j, " is not connected to ", self.base_link
+                continue
+            self.base_link = base
+        self.tip_link = self.urdf.joint_map[ordered[-1]].child
+
+        # every URDF joint on the paths from the base to the group's joints, parents first
+        tree = set()
+        for j in ordered :
+            if self.urdf.is_in_subtree(self.urdf.joint_map[j].child, self.base_link) :
+                tree.update(self.urdf.get_chain(self.base_link, self.urdf.joint_map[j].child, links=False))
+        tree = sorted(tree, key=lambda j: self.urdf.get_link_depth(self.urdf.joint_map[j].child))
+
+        # link -> (index of the moving joint it hangs off, static frame from that joint)
+        link_frames = {self.base_link : (-1, kdl.Frame())}
+        for j in tree :
+            model_joint = self.urdf.joint_map[j]
+            child_link = self.urdf.link_map[model_joint.child]
+            (parent, T_parent) = link_frames[model_joint.parent]
+            T_static = T_parent*self.urdf.get_joint_origin_frame(j)
+
+            kernel = BATCH_JOINT_KERNELS.get(model_joint.type)
+            if kernel :
+                self.joints.append(j)
+                self.joint_parents.append(parent)
+                self.joint_axes.append(get_joint_axis(model_joint))
+                self.batch_kernels.append(kernel)
+                self.origin_matrices.append(toMatrix(T_static))
+                (parent, T_static) = (len(self.joints)-1, kdl.Frame())
+            link_frames[child_link.name] = (parent, T_static)
+
+            if link_has_mesh(child_link) :
+                T_viz = T_static*self.urdf.get_visual_origin_frame(child_link.name)
+                self.mesh_links.append((child_link.name, parent, child_link.visual.geometry.filename))
+                self.visual_matrices.append(toMatrix(T_viz))
+
+        if self.tip_link in link_frames :
+            (self.tip_index, T_tip) = link_frames[self.tip_link]
+            self.tip_offset_matrix = toMatrix(T_tip)
+
+    def get_joint_depth(self, joint) :
+        return self.urdf.get_link_depth(self.urdf.joint_map[joint].parent)
+
+    def get_base_link(self) :
+        return self.base_link
+
+    def get_tip_link(self) :
+        return self.tip_link
+
+    def get_mesh_links(self) :
+        return [m[0] for m in self.mesh_links]
+
+    def get_mesh_resources(self) :
+        return [m[2] for m in self.mesh_links]
+
+    def get_permutation(self, names) :
+        key = tuple(names)
+        if not key in self.permutations :
+            index = dict((n,i) for i,n in enumerate(names))
+            self.permutations[key] = [index.get(j,-1) for j in self.joints]
+        return self.permutations[key]
+
+    def get_link_transforms(self, names, positions, T_base=None) :
+        # batch FK over an (N x J) array of joint positions ordered as names.
+        # returns an (N x L x 4 x 4) stack of mesh link transforms (ordered as
+        # get_mesh_links()) and the (N x 4 x 4) stack of tip link transforms
+        positions = numpy.array(positions, dtype=float, ndmin=2)
+        N = positions.shape[0]
+        if T_base is None : T_base = numpy.identity(4)
+        T_base = numpy.tile(T_base, (N,1,1))
+        perm = self.get_permutation(names)
+        T_joint = []
+        for i in range(len(self.joints)) :
+            T = numpy.einsum('nij,jk->nik', self.get_parent_frame(T_joint, self.joint_parents[i], T_base), self.origin_matrices[i])
+            if perm[i] >= 0 and self.batch_kernels[i] :
+                T = numpy.einsum('nij,njk->nik', T, self.batch_kernels[i](self.joint_axes[i], positions[:,perm[i]]))
+            T_joint.append(T)
+        link_transforms = numpy.zeros((N,len(self.mesh_links),4,4))
+        for (l, (link, parent, mesh)) in enumerate(self.mesh_links) :
+            link_transforms[:,l] = numpy.einsum('nij,jk->nik', self.get_parent_frame(T_joint, parent, T_base), self.visual_matrices[l])
+        return link_transforms, numpy.einsum('nij,jk->nik', self.get_parent_frame(T_joint, self.tip_index, T_base), self.tip_offset_matrix)
+
+    def get_parent_frame(self, T_joint, parent, T_base) :
+        if parent < 0 : return T_base
+        return T_joint[parent]
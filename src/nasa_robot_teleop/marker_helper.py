@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import copy
+
 from interactive_markers.interactive_marker_server import *
 from interactive_markers.menu_handler import *
 from visualization_msgs.msg import *
@@ -150,3 +152,67 @@ def make6DOFControls() :
     controls.append(makeYRotControl())
     controls.append(makeZRotControl())
     return controls
+
+class MarkerPool :
+    # pre-filled marker templates, keyed by whatever the owner likes (e.g. link name),
+    # and the marker instances handed out from them. instances are reused from call
+    # to call so callers only need to write the pose, id and stamp of each marker.
+
+    def __init__(self) :
+        self.templates = {}
+        self.markers = {}
+
+    def add_template(self, key, marker) :
+        self.templates[key] = marker
+        self.markers[key] = {}
+
+    def has_template(self, key) :
+        return key in self.templates
+
+    def get_marker(self, key, slot=0) :
+        pool = self.markers[key]
+        if not slot in pool :
+            pool[slot] = copy.deepcopy(self.templates[key])
+        return pool[slot]
+
+    def clear(self) :
+        self.templates = {}
+        self.markers = {}
+
+class MarkerIdAllocator :
+    # hands each owner (e.g. a group) a contiguous block of marker ids sized
+    # waypoints x markers-per-waypoint, so ids are predictable, can be looked up
+    # directly from (owner, waypoint, link) and a whole owner can be cleared by range.
+
+    def __init__(self, first_id=0) :
+        self.next_id = first_id
+        self.ranges = {}
+
+    def allocate(self, owner, num_waypoints, num_links) :
+        # keeps the current block if it is big enough, otherwise moves the owner to a new one
+        num_waypoints = max(1, num_waypoints)
+        num_links = max(1, num_links)
+        if owner in self.ranges :
+            (first, waypoints, links) = self.ranges[owner]
+            if waypoints >= num_waypoints and links >= num_links :
+                return first
+            num_waypoints = max(waypoints, num_waypoints)
+            num_links = max(links, num_links)
+        first = self.next_id
+        self.next_id += num_waypoints*num_links
+        self.ranges[owner] = (first, num_waypoints, num_links)
+        return first
+
+    def has_owner(self, owner) :
+        return owner in self.ranges
+
+    def get_first_id(self, owner) :
+        return self.ranges[owner][0]
+
+    def get_id(self, owner, waypoint, link) :
+        (first, waypoints, links) = self.ranges[owner]
+        return first + waypoint*links + link
+
+    def get_range(self, owner) :
+        (first, waypoints, links) = self.ranges[owner]
+        return xrange(first, first + waypoints*links)
@@ -4,13 +4,16 @@ import os
 import sys
 import copy
 import math
-import random
+import time
+import numpy
+import threading
 
 import rospy
 import roslib; roslib.load_manifest('nasa_robot_teleop')
 from rospkg import RosPack
 
 import tf
+import actionlib
 
 import geometry_msgs.msg
 import visualization_msgs.msg
@@ -18,6 +21,8 @@ import sensor_msgs.msg
 import trajectory_msgs.msg
 
 import controller_manager_msgs.srv
+import control_msgs.msg
+import actionlib_msgs.msg
 
 import moveit_commander
 import moveit_msgs.msg
@@ -28,6 +33,12 @@ from srdf_model import SRDFModel
 from kdl_posemath import *
 import urdf_parser_py as urdf
 from urdf_helper import *
+from kinematic_chain import KinematicChain
+from path_helper import select_path_waypoints
+from marker_helper import MarkerPool, MarkerIdAllocator
+from pose_cache import PoseTransformCache
+from frame_tracker import FrameTracker
+from planning_lane import PlanningLane, wait_for_futures
 import end_effector_helper as end_effector
 
 class MoveItInterface :
@@ -46,17 +57,33 @@ class MoveItInterface :
         self.end_effector_map = {}
         self.trajectory_publishers = {}
         self.display_modes = {}
+        self.path_marker_budgets = {}
+        self.path_decimation_metrics = {}
         self.trajectory_poses = {}
         self.trajectory_display_markers = {}
         self.end_effector_display = {}
         self.plan_generated = {}
         self.marker_store = {}
+        self.published_markers = {}
+        self.marker_ids = MarkerIdAllocator()
         self.stored_plans = {}
+        self.kinematic_chains = {}
+        self.path_marker_pools = {}
+        self.chain_base_frames = {}
+        self.end_effector_offsets = {}
+        self.pose_cache = PoseTransformCache()
+        self.planning_lanes = {}
+        self.planning_lane_lock = threading.Lock()
+        self.marker_id_lock = threading.Lock()
 
         self.command_topics = {}
+        self.trajectory_action_clients = {}
 
         self.plan_color = (0.5,0.1,0.75,.5)
         self.path_increment = 2
+        self.chain_base_frame_timeout = rospy.Duration(0.5)
+        self.end_effector_offset_timeout = rospy.Duration(5.0)
+        self.default_path_marker_budget = 250
 
         print "============ Setting up MoveIt! for robot: \'", self.robot_name, "\'"
         self.robot = moveit_commander.RobotCommander()
@@ -77,6 +104,10 @@ class MoveItInterface :
 
         self.tf_listener = tf.TransformListener()
 
+        # one shared thread tracks every frame the interface and its users need
+        self.frame_tracker = FrameTracker(self.tf_listener)
+        self.frame_tracker.start()
+
 
     def create_models(self, config_package) :
 
@@ -116,13 +147,12 @@ class MoveItInterface :
             topic_name = "/" + self.robot_name + "/" + controller_name + "/command"
             # print "COMMAND TOPIC: ", topic_name
             self.command_topics[group_name] = rospy.Publisher(topic_name, trajectory_msgs.msg.JointTrajectory)
-            id_found = False
-            while not id_found :
-                r =  int(random.random()*10000000)
-                if not r in self.group_id_offset.values() :
-                    self.group_id_offset[group_name] = r
-                    id_found = True
-                    # print "generated offset ", r, " for group ", group_name
+            # compile the group's kinematic chain once for path previews
+            if self.group_types[group_name] != "endeffector" :
+                self.kinematic_chains[group_name] = KinematicChain(self.urdf_model, self.groups[group_name].get_active_joints())
+                self.create_path_marker_pool(group_name)
+            self.path_marker_budgets[group_name] = self.default_path_marker_budget
+            self.path_decimation_metrics[group_name] = "joint"
 
             # check to see if the group has an associated end effector, and add it if so
             if self.groups[group_name].has_end_effector_link() :
@@ -143,8 +173,14 @@ class MoveItInterface :
                 ee_link = self.urdf_model.link_map[self.control_frames[group_name]]
                 self.control_meshes[group_name] = ee_link.visual.geometry.filename
                 self.end_effector_display[group_name] = end_effector.EndEffectorHelper(self.robot_name, group_name, self.get_control_frame(group_name), self.tf_listener)
+                self.end_effector_display[group_name].set_pose_cache(self.pose_cache)
+                self.end_effector_display[group_name].set_frame_tracker(self.frame_tracker)
                 self.end_effector_display[group_name].populate_data(self.get_group_links(group_name), self.get_urdf_model(), self.get_srdf_model())
 
+            # reserve a block of path marker ids sized to the group's marker budget
+            if self.group_types[group_name] != "endeffector" :
+                self.allocate_path_marker_ids(group_name, self.path_marker_budgets[group_name]/max(1, self.get_markers_per_waypoint(group_name)))
+
             return True
 
         except :
@@ -249,8 +285,15 @@ class MoveItInterface :
     def get_srdf_model(self) :
         return self.srdf_model
 
+    def get_pose_cache(self) :
+        return self.pose_cache
+
+    def get_frame_tracker(self) :
+        return self.frame_tracker
+
     def get_trajectory_display_markers(self, group) :
-        if group in self.trajectory_display_markers : return self.trajectory_display_markers[group]
+        # the stored markers are pooled and get rewritten by the next preview, so hand out a copy
+        if group in self.trajectory_display_markers : return copy.deepcopy(self.trajectory_display_markers[group])
         else : return visualization_msgs.msg.MarkerArray()
 
     def get_base_frame(self, group) :
@@ -267,65 +310,214 @@ class MoveItInterface :
     def set_display_mode(self, group, mode) :
         self.display_modes[group] = mode
 
+    def set_path_marker_budget(self, group, budget) :
+        self.path_marker_budgets[group] = budget
+        if group in self.kinematic_chains :
+            self.allocate_path_marker_ids(group, budget/max(1, self.get_markers_per_waypoint(group)))
+
+    def allocate_path_marker_ids(self, group, num_waypoints) :
+        # groups plan on their own lanes, so blocks may be handed out concurrently
+        with self.marker_id_lock :
+            self.group_id_offset[group] = self.marker_ids.allocate(group, num_waypoints, self.get_markers_per_waypoint(group))
+
+    def set_path_decimation_metric(self, group, metric) :
+        # "joint" spaces waypoints in joint space, "cartesian" by the chain tip position
+        if not metric in ["joint", "cartesian"] :
+            rospy.logerr(str("MoveItInterface::set_path_decimation_metric() -- unknown metric: " + metric))
+            return
+        self.path_decimation_metrics[group] = metric
+
+    def get_markers_per_waypoint(self, group) :
+        n = len(self.kinematic_chains[group].get_mesh_links())
+        if group in self.end_effector_map and self.group_types[group] == "manipulator":
+            ee_group = self.srdf_model.end_effectors[self.end_effector_map[group]].group
+            if ee_group in self.end_effector_display :
+                n += len(self.end_effector_display[ee_group].get_links())
+        return n
+
+    def get_adaptive_path_points(self, plan, group) :
+        # choose waypoints by joint space or tip distance so the whole path fits the group's marker budget
+        points = plan.joint_trajectory.points
+        budget = max(2, self.path_marker_budgets[group]/max(1, self.get_markers_per_waypoint(group)))
+        if len(points) <= budget : return points
+        samples = numpy.array([p.positions for p in points])
+        if self.path_decimation_metrics[group] == "cartesian" :
+            link_transforms, tip_transforms = self.kinematic_chains[group].get_link_transforms(plan.joint_trajectory.joint_names, samples)
+            samples = tip_transforms[:,0:3,3]
+        return [points[i] for i in select_path_waypoints(samples, budget)]
+
     def joint_state_callback(self, data):
         self.currentState = data
 
     def clear_published_path(self,group) :
+        # bulk delete over the group's whole id range
+        markers = visualization_msgs.msg.MarkerArray()
+        markers.markers = []
+        if self.marker_ids.has_owner(group) :
+            signature = (self.robot_name, self.groups[group].get_planning_frame())
+            for marker_id in self.marker_ids.get_range(group) :
+                markers.markers.append(self.create_delete_marker(marker_id, signature))
+        self.published_markers[group] = {}
+        if len(markers.markers) > 0 :
+            self.path_visualization.publish(markers)
+
+    def publish_path_markers(self, group, path_markers) :
+        # only send what changed since the last publish for this group: ADD for new ids,
+        # MODIFY for markers that moved, and DELETE for ids that are no longer in the path
+        last = {}
+        if group in self.published_markers : last = self.published_markers[group]
+        current = {}
         markers = visualization_msgs.msg.MarkerArray()
         markers.markers = []
-        for m in self.marker_store[group].markers :
-            marker = copy.deepcopy(m)
-            marker.action = visualization_msgs.msg.Marker.DELETE
-            markers.markers.append(marker)
-        self.path_visualization.publish(markers)
+        for m in path_markers.markers :
+            signature = self.get_marker_signature(m)
+            current[m.id] = signature
+            if not m.id in last :
+                m.action = visualization_msgs.msg.Marker.ADD
+                markers.markers.append(m)
+            elif last[m.id] != signature :
+                m.action = visualization_msgs.msg.Marker.MODIFY
+                markers.markers.append(m)
+        for marker_id in last :
+            if not marker_id in current :
+                markers.markers.append(self.create_delete_marker(marker_id, last[marker_id]))
+        self.published_markers[group] = current
+        if len(markers.markers) > 0 :
+            self.path_visualization.publish(markers)
+
+    def get_marker_signature(self, m) :
+        p = m.pose
+        return (m.ns, m.header.frame_id, m.mesh_resource,
+            p.position.x, p.position.y, p.position.z,
+            p.orientation.x, p.orientation.y, p.orientation.z, p.orientation.w,
+            m.color.r, m.color.g, m.color.b, m.color.a)
+
+    def create_delete_marker(self, marker_id, signature) :
+        marker = visualization_msgs.msg.Marker()
+        marker.ns = signature[0]
+        marker.header.frame_id = signature[1]
+        marker.id = marker_id
+        marker.action = visualization_msgs.msg.Marker.DELETE
+        return marker
 
     def publish_path_data(self, plan, group) :
         if plan != None :
-            self.clear_published_path(group)
             display_trajectory = moveit_msgs.msg.DisplayTrajectory()
             display_trajectory.trajectory_start = self.robot.get_current_state()
             display_trajectory.trajectory.append(plan)
             self.trajectory_publishers[group].publish(display_trajectory)
             if self.group_types[group] != "endeffector" :
                 path_visualization_marker_array = self.joint_trajectory_to_marker_array(plan, group, self.display_modes[group])
-                self.path_visualization.publish(path_visualization_marker_array)
+                self.publish_path_markers(group, path_visualization_marker_array)
+            else :
+                self.clear_published_path(group)
 
     def create_joint_plan_to_target(self, group_name, js) :
+        return self.store_plan(group_name, self.compute_joint_plan_to_target(group_name, js))
+
+    def create_plan_to_target(self, group_name, pt) :
+        return self.store_plan(group_name, self.compute_plan_to_target(group_name, pt))
+
+    def create_random_target(self, group_name) :
+        return self.store_plan(group_name, self.compute_random_plan(group_name))
+
+    def create_path_plan(self, group_name, frame_id, pt_list) :
+        return self.store_plan(group_name, self.compute_path_plan(group_name, frame_id, pt_list))
+
+    def create_joint_plan_to_target_async(self, group_name, js, callback=None) :
+        return self.submit_planning_request(group_name, "joint_plan", self.compute_joint_plan_to_target, callback, group_name, js)
+
+    def create_plan_to_target_async(self, group_name, pt, callback=None) :
+        return self.submit_planning_request(group_name, "pose_plan", self.compute_plan_to_target, callback, group_name, pt)
+
+    def create_random_target_async(self, group_name, callback=None) :
+        return self.submit_planning_request(group_name, "random_plan", self.compute_random_plan, callback, group_name)
+
+    def create_path_plan_async(self, group_name, frame_id, pt_list, callback=None) :
+        return self.submit_planning_request(group_name, "path_plan", self.compute_path_plan, callback, group_name, frame_id, pt_list)
+
+    def execute_plan_async(self, group_name, from_stored=False, wait=True, callback=None, after=None) :
+        # runs after any planning already queued for the group. with after set to the
+        # future of that planning request, execution is skipped if the planning failed
+        # or was superseded. a newer plan may drop it while it waits, but never once the
+        # robot is moving.
+        future = self.get_planning_lane(group_name).submit("execute", self.execute_planned, (group_name, from_stored, wait, after), supersedable=False)
+        if callback != None : future.add_done_callback(callback)
+        return future
+
+    def execute_planned(self, future, group_name, from_stored, wait, after) :
+        if future.is_superseded() or (after != None and (after.exception != None or after.is_superseded())) :
+            print "====== Plan for Group %s failed or was superseded, not executing." % group_name
+            return False
+        return self.execute_plan(group_name, from_stored, wait)
+
+    def submit_planning_request(self, group_name, name, compute, callback, *args) :
+        # queue a plan on the group's planning lane, replacing any plan still waiting there,
+        # and return its PlanningFuture. the plan is stored and published unless a newer
+        # request superseded it in the meantime.
+        future = self.get_planning_lane(group_name).submit(name, self.run_planning_request, (group_name, compute, args), supersede=True)
+        if callback != None : future.add_done_callback(callback)
+        return future
+
+    def run_planning_request(self, future, group_name, compute, args) :
+        plan = compute(*args)
+        if future.is_superseded() :
+            print "===== Dropping superseded plan for Group %s" % group_name
+            return None
+        return self.store_plan(group_name, plan)
+
+    def get_planning_stats(self, group_name) :
+        return self.get_planning_lane(group_name).get_stats()
+
+    def get_planning_lane(self, group_name) :
+        with self.planning_lane_lock :
+            if not group_name in self.planning_lanes :
+                self.planning_lanes[group_name] = PlanningLane(group_name)
+                self.planning_lanes[group_name].start()
+            return self.planning_lanes[group_name]
+
+    def store_plan(self, group_name, plan) :
+        # keep plan as the group's current plan and publish its preview
+        self.stored_plans[group_name] = plan
+        self.publish_path_data(plan, group_name)
+        self.plan_generated[group_name] = True
+        return plan
+
+    def compute_joint_plan_to_target(self, group_name, js) :
         print "== Robot Name: %s" % self.robot_name
         print "===== MoveIt! Group Name: ", group_name
         js.header.stamp = rospy.get_rostime()
         js.header.frame_id = self.get_planning_frame()
         print "===== Generating Joint Plan "
+        self.groups[group_name].clear_pose_targets()
         self.groups[group_name].set_joint_value_target(js)
-        self.stored_plans[group_name] = self.groups[group_name].plan()
+        plan = self.groups[group_name].plan()
         print "===== Joint Plan Found"
-        self.publish_path_data(self.stored_plans[group_name], group_name)
-        self.plan_generated[group_name] = True
+        return plan
 
-    def create_plan_to_target(self, group_name, pt) :
+    def compute_plan_to_target(self, group_name, pt) :
         if pt.header.frame_id != self.groups[group_name].get_planning_frame() :
             self.tf_listener.waitForTransform(pt.header.frame_id, self.groups[group_name].get_planning_frame(), rospy.Time(0), rospy.Duration(5.0))
             pt = self.tf_listener.transformPose(self.groups[group_name].get_planning_frame(), pt)
         print "== Robot Name: %s" % self.robot_name
         print "===== MoveIt! Group Name: %s" % group_name
         print "===== Generating Plan"
+        self.groups[group_name].clear_pose_targets()
         self.groups[group_name].set_pose_target(pt)
-        self.stored_plans[group_name] = self.groups[group_name].plan()
+        plan = self.groups[group_name].plan()
         print "===== Plan Found"
-        self.publish_path_data(self.stored_plans[group_name], group_name)
-        self.plan_generated[group_name] = True
+        return plan
 
-    def create_random_target(self, group_name) :
+    def compute_random_plan(self, group_name) :
         print "== Robot Name: %s" % self.robot_name
         print "===== MoveIt! Group Name: %s" % group_name
         print "===== Generating Random Joint Plan"
         self.groups[group_name].set_random_target()
-        self.stored_plans[group_name] = self.groups[group_name].plan()
+        plan = self.groups[group_name].plan()
         print "===== Random Joint Plan Found"
-        self.publish_path_data(self.stored_plans[group_name], group_name)
-        self.plan_generated[group_name] = True
+        return plan
 
-    def create_path_plan(self, group_name, frame_id, pt_list) :
+    def compute_path_plan(self, group_name, frame_id, pt_list) :
         print "== Robot Name: %s" % self.robot_name
         print "===== MoveIt! Group Name: %s" % group_name
         print "===== Generating Plan"
@@ -368,13 +560,9 @@ class MoveItInterface :
             waypoints.append(copy.deepcopy(pt.pose))
 
         (plan, fraction) = self.groups[group_name].compute_cartesian_path(waypoints, 0.02, 0.0)
-        self.stored_plans[group_name] = plan
         # self.groups[group_name].set_pose_targets(waypoints)
         # self.stored_plans[group_name] = self.groups[group_name].plan()
 
-        self.publish_path_data(self.stored_plans[group_name], group_name)
-        self.plan_generated[group_name] = True
-
         # print "============ Waiting while RVIZ displays plan..."
         # rospy.sleep(3)
         # for wp in waypoints:
@@ -383,22 +571,135 @@ class MoveItInterface :
 
         # print self.stored_plans[group_name]
         # print "------------------\n"
+        return plan
 
     def execute_all_valid_plans(self, from_stored=False, wait=True) :
+        # stored plans go straight to each group's controller at a shared start time, so
+        # every group moves at once. otherwise each group is sent through move_group in
+        # turn, since a new move_group goal preempts the one still running.
+        groups = []
         r = True
         for g in self.robot.get_group_names() :
             if self.plan_generated[g] :
-                print "====== Executing Plan for Group: %s" % g
-                if from_stored :
-                    r = r and self.groups[g].execute(self.stored_plans[g])
-                else :
-                    r = self.groups[g].go(wait)
-                print "====== Plan Execution: %s" % r
+                groups.append(g)
             else :
                 r = False
                 print "====== No Plan for Group %s yet generated." % g
+        if from_stored :
+            results = self.execute_multiple(groups, wait)
+            for g in groups :
+                r = r and results[g]["success"]
+        else :
+            for g in groups :
+                r = self.execute_plan(g, False, wait) and r
         return r
 
+    def plan_multiple(self, targets, timeout=None) :
+        # plan for several groups in parallel. targets maps group -> target, where a target
+        # is a PoseStamped, a JointState or the name of a stored group state. returns
+        # group -> {"success", "result", "duration"} once every group is done (or timeout),
+        # with the plan as the result
+        futures = {}
+        for (group_name, target) in targets.items() :
+            if isinstance(target, str) :
+                target = self.get_stored_group_state(group_name, target)
+            if isinstance(target, geometry_msgs.msg.PoseStamped) :
+                futures[group_name] = self.create_plan_to_target_async(group_name, target)
+            else :
+                futures[group_name] = self.create_joint_plan_to_target_async(group_name, target)
+        wait_for_futures(futures.values(), timeout)
+        results = self.get_multiple_results(futures, "Plan")
+        for group_name in results :
+            plan = results[group_name]["result"]
+            # MoveIt! returns an empty trajectory when planning fails
+            if plan != None and len(plan.joint_trajectory.points) == 0 :
+                results[group_name]["success"] = False
+        return results
+
+    def execute_multiple(self, groups, wait=True, timeout=None, lead_time=0.2) :
+        # execute the stored plans of several groups together. each trajectory goes to its
+        # group's controller as a FollowJointTrajectory goal with the same start time,
+        # lead_time seconds from now, so the controllers start in step without going
+        # through move_group. with wait set this blocks until every controller reported a
+        # result (or timeout, goals still running then are left running and count as
+        # failed). returns group -> {"success", "result", "duration"}: success is whether
+        # the controller reports the trajectory done (without wait, whether the goal was
+        # sent), result the FollowJointTrajectoryResult and duration the measured seconds
+        # from the start time to the controller's result.
+        start_time = rospy.get_rostime() + rospy.Duration(lead_time)
+        end_times = {}
+        clients = {}
+        results = {}
+        for group_name in groups :
+            results[group_name] = {"success" : False, "result" : None, "duration" : None}
+            if not self.plan_generated[group_name] or self.stored_plans[group_name] == None :
+                print "====== No Plan for Group %s yet generated." % group_name
+                continue
+            client = self.get_trajectory_action_client(group_name)
+            if client == None : continue
+            goal = control_msgs.msg.FollowJointTrajectoryGoal()
+            goal.trajectory = copy.copy(self.stored_plans[group_name].joint_trajectory)
+            goal.trajectory.header = copy.copy(goal.trajectory.header)
+            goal.trajectory.header.stamp = start_time
+            print "====== Executing Plan for Group: %s" % group_name
+            client.send_goal(goal, done_cb=lambda state, result, g=group_name: end_times.__setitem__(g, rospy.get_rostime()))
+            clients[group_name] = client
+            results[group_name]["success"] = True
+
+        if not wait : return results
+
+        deadline = None
+        if timeout != None : deadline = rospy.get_rostime() + rospy.Duration(timeout)
+        for (group_name, client) in clients.items() :
+            remaining = rospy.Duration(0)
+            if deadline != None : remaining = max(rospy.Duration(0.001), deadline - rospy.get_rostime())
+            finished = client.wait_for_result(remaining)
+            result = client.get_result()
+            success = finished and client.get_state() == actionlib_msgs.msg.GoalStatus.SUCCEEDED and result != None and result.error_code == control_msgs.msg.FollowJointTrajectoryResult.SUCCESSFUL
+            duration = None
+            if group_name in end_times : duration = (end_times[group_name] - start_time).to_sec()
+            results[group_name] = {"success" : success, "result" : result, "duration" : duration}
+            print "====== Execution for Group %s: %s (%s s)" % (group_name, success, duration)
+        return results
+
+    def get_trajectory_action_client(self, group_name, timeout=1.0) :
+        # FollowJointTrajectory client of the group's controller, or None if its action
+        # server does not come up within timeout seconds
+        if not group_name in self.trajectory_action_clients :
+            action_name = "/" + self.robot_name + "/" + self.lookup_controller_name(group_name) + "/follow_joint_trajectory"
+            client = actionlib.SimpleActionClient(action_name, control_msgs.msg.FollowJointTrajectoryAction)
+            if not client.wait_for_server(rospy.Duration(timeout)) :
+                rospy.logerr(str("MoveItInterface::get_trajectory_action_client() -- no action server at " + action_name))
+                return None
+            self.trajectory_action_clients[group_name] = client
+        return self.trajectory_action_clients[group_name]
+
+    def plan_and_execute_multiple(self, targets, wait=True, timeout=None) :
+        # plan every group in parallel, then execute them together only if all of them planned,
+        # so a bimanual motion never starts with one arm. timeout covers both phases together.
+        # returns (success, plan results, execution results)
+        deadline = None
+        if timeout != None : deadline = time.time() + timeout
+        plan_results = self.plan_multiple(targets, timeout)
+        if not all([plan_results[g]["success"] for g in plan_results]) :
+            print "====== Not all groups planned, not executing."
+            return (False, plan_results, {})
+        if deadline != None : timeout = max(0.0, deadline - time.time())
+        execution_results = self.execute_multiple(targets.keys(), wait, timeout)
+        success = all([execution_results[g]["success"] for g in execution_results])
+        return (success, plan_results, execution_results)
+
+    def get_multiple_results(self, futures, label) :
+        results = {}
+        for (group_name, future) in futures.items() :
+            result = None
+            if future.done() and future.exception == None :
+                result = future.result
+            success = future.done() and future.exception == None and not future.is_superseded() and (result != None and result != False)
+            results[group_name] = {"success" : success, "result" : result, "duration" : future.get_duration()}
+            print "====== %s for Group %s: %s (%s s)" % (label, group_name, success, future.get_duration())
+        return results
+
     def execute_plan(self, group_name, from_stored=False, wait=True) :
         if self.plan_generated[group_name] :
             print "====== Executing Plan for Group: %s" % group_name
@@ -442,119 +743,133 @@ class MoveItInterface :
         joint_start = self.robot.get_current_state().joint_state
         num_points = len(plan.joint_trajectory.points)
         if num_points == 0 : return markers
-        idx = 0
-
-        ee_offset = toPose((0,0,0), (0,0,0,1))
 
         if display_mode == "all_points" :
-
-            for point in plan.joint_trajectory.points[1:num_points-1:self.path_increment] :
-                waypoint_markers, end_pose, last_link = self.create_marker_array_from_joint_array(group, plan.joint_trajectory.joint_names, point.positions, self.groups[group].get_planning_frame(), idx, self.plan_color[3])
-                idx += self.group_id_offset[group]
-                idx += len(waypoint_markers)
-                for m in waypoint_markers: markers.markers.append(m)
-
-                if self.groups[group].has_end_effector_link() and self.group_types[group] == "manipulator":
-                    ee_group = self.srdf_model.end_effectors[self.end_effector_map[group]].group
-                    ee_root_frame = self.end_effector_display[ee_group].get_root_frame()
-
-                    if last_link != ee_root_frame :
-                        self.tf_listener.waitForTransform(last_link, ee_root_frame, rospy.Time(0), rospy.Duration(5.0))
-                        (trans, rot) = self.tf_listener.lookupTransform(last_link, ee_root_frame, rospy.Time(0))
-                        rot = normalize_vector(rot)
-                        ee_offset = toPose(trans, rot)
-
-                    offset_pose = toMsg(end_pose*fromMsg(ee_offset))
-                    end_effector_markers = self.end_effector_display[ee_group].get_current_position_marker_array(offset=offset_pose, scale=1, color=self.plan_color, root=self.groups[group].get_planning_frame(), idx=idx)
-                    for m in end_effector_markers.markers: markers.markers.append(m)
-                    idx += len(end_effector_markers.markers)
-
+            points = plan.joint_trajectory.points[1:num_points-1:self.path_increment]
         elif display_mode == "last_point" :
-
-            if num_points > 0 :
-                points = plan.joint_trajectory.points[num_points-1]
-                waypoint_markers, end_pose, last_link = self.create_marker_array_from_joint_array(group,plan.joint_trajectory.joint_names, points.positions, self.groups[group].get_planning_frame(), idx, self.plan_color[3])
-                for m in waypoint_markers: markers.markers.append(m)
-                idx += self.group_id_offset[group]
-                idx += len(waypoint_markers)
-
-                if self.groups[group].has_end_effector_link() and self.group_types[group] == "manipulator":
-                    ee_group = self.srdf_model.end_effectors[self.end_effector_map[group]].group
-                    ee_root_frame = self.end_effector_display[ee_group].get_root_frame()
-                    if last_link != ee_root_frame :
-                        self.tf_listener.waitForTransform(last_link, ee_root_frame, rospy.Time(0), rospy.Duration(5.0))
-                        (trans, rot) = self.tf_listener.lookupTransform(last_link, ee_root_frame, rospy.Time(0))
-                        rot = normalize_vector(rot)
-                        ee_offset = toPose(trans, rot)
-
-                    offset_pose = toMsg(end_pose*fromMsg(ee_offset))
-                    end_effector_markers = self.end_effector_display[ee_group].get_current_position_marker_array(offset=offset_pose, scale=1, color=self.plan_color, root=self.groups[group].get_planning_frame(), idx=idx)
-                    for m in end_effector_markers.markers: markers.markers.append(m)
-                    idx += len(end_effector_markers.markers)
+            points = plan.joint_trajectory.points[num_points-1:]
+        elif display_mode == "adaptive_points" :
+            points = self.get_adaptive_path_points(plan, group)
+        else :
+            points = []
+
+        # resolve the chain base once for the whole trajectory, then run batch FK over every displayed waypoint
+        root_frame = self.groups[group].get_planning_frame()
+        chain = self.kinematic_chains[group]
+        num_links = len(chain.get_mesh_links())
+        self.allocate_path_marker_ids(group, len(points))
+        if len(points) > 0 :
+            T_root = self.lookup_chain_base_frame(group, root_frame)
+            positions = numpy.array([p.positions for p in points])
+            link_transforms, tip_transforms = chain.get_link_transforms(plan.joint_trajectory.joint_names, positions, toMatrix(T_root))
+
+        # draw every end effector ghost from the same snapshot of the hand
+        ee_snapshot = None
+        if self.groups[group].has_end_effector_link() and self.group_types[group] == "manipulator":
+            ee_group = self.srdf_model.end_effectors[self.end_effector_map[group]].group
+            ee_snapshot = self.end_effector_display[ee_group].get_pose_snapshot()
+
+        for n in range(len(points)) :
+            waypoint_markers = self.create_marker_array_from_link_transforms(group, link_transforms[n], root_frame, n)
+            end_pose = fromMatrix(tip_transforms[n])
+            last_link = chain.get_tip_link()
+            for m in waypoint_markers: markers.markers.append(m)
+
+            if self.groups[group].has_end_effector_link() and self.group_types[group] == "manipulator":
+                ee_group = self.srdf_model.end_effectors[self.end_effector_map[group]].group
+                ee_root_frame = self.end_effector_display[ee_group].get_root_frame()
+                T_ee = self.get_end_effector_offset(group, last_link, ee_root_frame)
+                offset_pose = toMsg(end_pose*T_ee)
+                idx = self.marker_ids.get_id(group, n, num_links)
+                end_effector_markers = self.end_effector_display[ee_group].get_current_position_marker_array(offset=offset_pose, scale=1, color=self.plan_color, root=root_frame, idx=idx, slot=n, snapshot=ee_snapshot)
+                for m in end_effector_markers.markers: markers.markers.append(m)
 
         self.marker_store[group] = markers
-        self.trajectory_display_markers[group] = copy.deepcopy(markers)
+        self.trajectory_display_markers[group] = markers
 
         print "--------------------"
         print "markers for group: ", group
         # print self.marker_store[group]
         return markers
 
-    def create_marker_array_from_joint_array(self, group, names, joints, root_frame, idx, alpha) :
+    def lookup_chain_base_frame(self, group, root_frame) :
+        # reuse a recent snapshot of the chain base so back to back previews don't each wait on tf
+        now = rospy.get_rostime()
+        if group in self.chain_base_frames :
+            (frame_id, T, stamp) = self.chain_base_frames[group]
+            if frame_id == root_frame and (now - stamp) < self.chain_base_frame_timeout :
+                return T
+        base_link = self.kinematic_chains[group].get_base_link()
+        self.tf_listener.waitForTransform(root_frame, base_link, rospy.Time(0), rospy.Duration(5.0))
+        (trans, rot) = self.tf_listener.lookupTransform(root_frame, base_link, rospy.Time(0))
+        rot = normalize_vector(rot)
+        T = fromMsg(toPose(trans,rot))
+        self.chain_base_frames[group] = (root_frame, T, now)
+        return T
+
+    def get_end_effector_offset(self, group, tip_link, ee_root_frame) :
+        # offset from the arm tip to the end effector root. this is taken from the URDF when
+        # only fixed joints separate them, otherwise it's a tf lookup that is reused until stale
+        if tip_link == ee_root_frame : return kdl.Frame()
+        now = rospy.get_rostime()
+        if group in self.end_effector_offsets :
+            (frames, T, stamp) = self.end_effector_offsets[group]
+            if frames == (tip_link, ee_root_frame) and (stamp is None or (now - stamp) < self.end_effector_offset_timeout) :
+                return T
+        T = get_static_offset(tip_link, ee_root_frame, self.urdf_model)
+        stamp = None
+        if T is None :
+            self.tf_listener.waitForTransform(tip_link, ee_root_frame, rospy.Time(0), rospy.Duration(5.0))
+            (trans, rot) = self.tf_listener.lookupTransform(tip_link, ee_root_frame, rospy.Time(0))
+            rot = normalize_vector(rot)
+            T = fromMsg(toPose(trans, rot))
+            stamp = now
+        self.end_effector_offsets[group] = ((tip_link, ee_root_frame), T, stamp)
+        return T
+
+    def create_marker_array_from_link_transforms(self, group, link_transforms, root_frame, waypoint) :
+        # fills in the pooled markers for one waypoint, only pose, id and stamp change per call
         markers = []
-        T_acc = kdl.Frame()
-        T_kin = kdl.Frame()
         now = rospy.get_rostime()
+        pool = self.path_marker_pools[group]
+        for (l, link) in enumerate(self.kinematic_chains[group].get_mesh_links()) :
+            marker = pool.get_marker(link, waypoint)
+            setMsgFromMatrix(marker.pose, link_transforms[l])
+            marker.header.frame_id = root_frame
+            marker.header.stamp = now
+            marker.id = self.marker_ids.get_id(group, waypoint, l)
+            markers.append(marker)
+        return markers
 
-        first_joint = True
-        for joint in names :
-
-            marker = visualization_msgs.msg.Marker()
-            parent_link = self.urdf_model.link_map[self.urdf_model.joint_map[joint].parent]
-            child_link = self.urdf_model.link_map[self.urdf_model.joint_map[joint].child]
-            model_joint = self.urdf_model.joint_map[joint]
-
-            # print "joint: ", model_joint.name
-            # print "parent link: ", parent_link.name
-            # print "child link: ", child_link.name
-
-            joint_val = joints[names.index(joint)]
-            T_joint = get_joint_rotation(model_joint.axis, joint_val)
-
-            if first_joint :
-                first_joint = False
-                self.tf_listener.waitForTransform(root_frame, parent_link.name, rospy.Time(0), rospy.Duration(5.0))
-                (trans, rot) = self.tf_listener.lookupTransform(root_frame, parent_link.name, rospy.Time(0))
-                rot = normalize_vector(rot)
-                T_acc = fromMsg(toPose(trans,rot))
-
-            T_kin = fromMsg(joint_origin_to_pose(model_joint))
-            T_acc = T_acc*T_kin*T_joint
-
-            if link_has_mesh(child_link) :
-                T_viz = fromMsg(link_origin_to_pose(child_link))
-                T_link = T_acc*T_viz
-                marker.pose = toMsg(T_link)
-                marker.header.frame_id = root_frame
-                marker.header.stamp = now
-                marker.ns = self.robot_name
-                marker.text = joint
-                marker.id = self.group_id_offset[group] + idx
-                marker.scale.x = 1
-                marker.scale.y = 1
-                marker.scale.z = 1
-                marker.color.r = self.plan_color[0]
-                marker.color.g = self.plan_color[1]
-                marker.color.b = self.plan_color[2]
-                marker.color.a = self.plan_color[3]
-                idx += 1
-                marker.mesh_resource = child_link.visual.geometry.filename
-                marker.type = visualization_msgs.msg.Marker.MESH_RESOURCE
-                marker.action = visualization_msgs.msg.Marker.ADD
-                marker.mesh_use_embedded_materials = True
-                markers.append(marker)
-
-        return markers, T_acc, child_link.name
+    def create_path_marker_pool(self, group) :
+        pool = MarkerPool()
+        chain = self.kinematic_chains[group]
+        meshes = chain.get_mesh_resources()
+        for (l, link) in enumerate(chain.get_mesh_links()) :
+            template = self.create_path_marker(group, link, meshes[l], geometry_msgs.msg.Pose(), self.groups[group].get_planning_frame(), rospy.Time(0), 0)
+            pool.add_template(link, template)
+        self.path_marker_pools[group] = pool
+
+    def create_path_marker(self, group, link, mesh, pose, root_frame, stamp, marker_id) :
+        marker = visualization_msgs.msg.Marker()
+        marker.pose = pose
+        marker.header.frame_id = root_frame
+        marker.header.stamp = stamp
+        marker.ns = self.robot_name
+        marker.text = link
+        marker.id = marker_id
+        marker.scale.x = 1
+        marker.scale.y = 1
+        marker.scale.z = 1
+        marker.color.r = self.plan_color[0]
+        marker.color.g = self.plan_color[1]
+        marker.color.b = self.plan_color[2]
+        marker.color.a = self.plan_color[3]
+        marker.mesh_resource = mesh
+        marker.type = visualization_msgs.msg.Marker.MESH_RESOURCE
+        marker.action = visualization_msgs.msg.Marker.ADD
+        marker.mesh_use_embedded_materials = True
+        return marker
 
     # def normalize_vector(self, v) :
     #     m = math.sqrt(math.fsum([x*x for x in v]))
@@ -659,6 +974,9 @@ class MoveItInterface :
     def tear_down(self) :
         for k in self.end_effector_display.keys() :
             self.end_effector_display[k].stop_offset_update_thread()
+        for g in self.planning_lanes.keys() :
+            self.planning_lanes[g].stop()
+        self.frame_tracker.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,45 @@
+#! /usr/bin/env python
+
+import numpy
+
+def get_turning_angles(samples) :
+    # angle between the incoming and outgoing segment at each interior sample
+    angles = numpy.zeros(len(samples))
+    if len(samples) < 3 : return angles
+    segments = numpy.diff(samples, axis=0)
+    lengths = numpy.sqrt((segments*segments).sum(axis=1))
+    a = segments[:-1]
+    b = segments[1:]
+    norms = lengths[:-1]*lengths[1:]
+    valid = norms > 1e-9
+    cos = numpy.ones(len(norms))
+    cos[valid] = (a[valid]*b[valid]).sum(axis=1)/norms[valid]
+    angles[1:-1] = numpy.arccos(numpy.clip(cos, -1.0, 1.0))
+    return angles
+
+def select_path_waypoints(samples, budget, min_angle=0.05) :
+    # pick at most budget indices out of an (N x D) array of path samples (joint
+    # positions or tip positions). the start and end are always kept, up to half
+    # the remaining budget goes to the sharpest turns, and the rest is spread
+    # evenly along the path length.
+    samples = numpy.array(samples, dtype=float, ndmin=2)
+    N = len(samples)
+    if N <= budget : return range(N)
+    if budget < 2 : return [N-1]
+
+    keep = set([0, N-1])
+
+    angles = get_turning_angles(samples)
+    for i in numpy.argsort(angles)[::-1][:(budget-2)/2] :
+        if angles[i] < min_angle : break
+        keep.add(int(i))
+
+    segments = numpy.diff(samples, axis=0)
+    s = numpy.concatenate(([0.0], numpy.cumsum(numpy.sqrt((segments*segments).sum(axis=1)))))
+    if s[-1] > 0 :
+        remaining = budget - len(keep)
+        for target in numpy.linspace(0.0, s[-1], remaining+2)[1:-1] :
+            if len(keep) >= budget : break
+            keep.add(int(numpy.argmin(numpy.abs(s - target))))
+
+    return sorted(keep)
@@ -0,0 +1,169 @@
+#! /usr/bin/env python
+
+import rospy
+
+import threading
+import collections
+import time
+
+class PlanningFuture :
+    # the eventual result of a request run on a PlanningLane. done callbacks run on the
+    # lane thread (or right away in add_done_callback if the request already finished).
+    def __init__(self, group, name, supersedable=True) :
+        self.group = group
+        self.name = name
+        # False for requests (like executions) that must not be flagged once running
+        self.supersedable = supersedable
+        self.result = None
+        self.exception = None
+        self.callbacks = []
+        self.event = threading.Event()
+        self.mutex = threading.Lock()
+        self.submit_time = time.time()
+        self.start_time = None
+        self.end_time = None
+        self.superseded = False
+
+    def supersede(self) :
+        # a newer request replaced this one, so its result must not be published or executed
+        self.superseded = True
+
+    def is_superseded(self) :
+        return self.superseded
+
+    def set_result(self, result) :
+        self.result = result
+        self.finish()
+
+    def set_exception(self, exception) :
+        self.exception = exception
+        self.finish()
+
+    def finish(self) :
+        self.end_time = time.time()
+        with self.mutex :
+            self.event.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        for callback in callbacks :
+            self.run_callback(callback)
+
+    def run_callback(self, callback) :
+        try :
+            callback(self)
+        except Exception as e :
+            rospy.logerr(str("PlanningFuture::run_callback() -- callback for " + self.name + " on group " + self.group + " failed: " + str(e)))
+
+    def add_done_callback(self, callback) :
+        with self.mutex :
+            if not self.event.is_set() :
+                self.callbacks.append(callback)
+                return
+        self.run_callback(callback)
+
+    def done(self) :
+        return self.event.is_set()
+
+    def wait(self, timeout=None) :
+        # True if the request finished within timeout seconds
+        return self.event.wait(timeout)
+
+    def get_result(self, timeout=None) :
+        # the request's return value. raises its exception if it failed, or
+        # RuntimeError if it did not finish within timeout seconds
+        if not self.event.wait(timeout) :
+            raise RuntimeError("PlanningFuture::get_result() -- " + self.name + " on group " + self.group + " timed out")
+        if self.exception != None : raise self.exception
+        return self.result
+
+    def get_duration(self) :
+        # seconds spent running the request, or None if it has not finished
+        if self.start_time == None or self.end_time == None : return None
+        return self.end_time - self.start_time
+
+
+class PlanningLane(threading.Thread) :
+    # a worker thread that runs the planning and execution requests of one group in
+    # submission order, so a group's MoveGroupCommander is only ever used by one
+    # request at a time while other groups plan in parallel on their own lanes.
+    #
+    # a request submitted with supersede set wins over everything before it: requests
+    # still waiting are dropped (finished with a None result) and the running one is
+    # flagged so its work can skip publishing or executing, unless it was submitted as
+    # not supersedable (an execution that already has the robot moving).
+    # function(future, *args) should check future.is_superseded() before acting on its result.
+    def __init__(self, group) :
+        super(PlanningLane,self).__init__()
+        self.group = group
+        self.name = group + "_planning_lane"
+        self.pending = collections.deque()
+        self.condition = threading.Condition()
+        self.current = None
+        self.submitted = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.running = True
+
+    def submit(self, name, function, args=(), supersede=False, supersedable=True) :
+        future = PlanningFuture(self.group, name, supersedable)
+        superseded = []
+        with self.condition :
+            if supersede :
+                superseded = list(self.pending)
+                self.pending.clear()
+                self.coalesced += len(superseded)
+                if self.current != None and self.current.supersedable : self.current.supersede()
+            self.pending.append((future, function, args))
+            self.submitted += 1
+            self.condition.notify()
+        for (old, function, args) in superseded :
+            old.supersede()
+            old.set_result(None)
+        return future
+
+    def run(self) :
+        while self.running and not rospy.is_shutdown() :
+            with self.condition :
+                if len(self.pending) == 0 :
+                    self.condition.wait(0.5)
+                    continue
+                (future, function, args) = self.pending.popleft()
+                self.current = future
+            self.run_request(future, function, args)
+            with self.condition :
+                self.current = None
+        print "Killing Planning Lane: ", self.name
+
+    def run_request(self, future, function, args) :
+        future.start_time = time.time()
+        try :
+            result = function(future, *args)
+        except Exception as e :
+            rospy.logerr(str("PlanningLane::run_request() -- " + future.name + " failed for group " + self.group + ": " + str(e)))
+            future.set_exception(e)
+            return
+        if future.is_superseded() :
+            with self.condition :
+                self.dropped += 1
+        future.set_result(result)
+
+    def get_stats(self) :
+        # submitted: requests queued, coalesced: dropped before they ran,
+        # dropped: ran but were superseded before their result was used
+        with self.condition :
+            return {"submitted" : self.submitted, "coalesced" : self.coalesced, "dropped" : self.dropped, "pending" : len(self.pending)}
+
+    def stop(self) :
+        self.running = False
+
+
+def wait_for_futures(futures, timeout=None) :
+    # completion barrier over a set of futures: blocks until all of them are done or the
+    # timeout (seconds, shared by all) passes. returns True if all finished in time.
+    deadline = None
+    if timeout != None : deadline = time.time() + timeout
+    for future in futures :
+        remaining = None
+        if deadline != None : remaining = max(0.0, deadline - time.time())
+        if not future.wait(remaining) : return False
+    return True
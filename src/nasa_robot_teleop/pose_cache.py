@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+
+import os
+import json
+import tempfile
+import threading
+import hashlib
+import numpy
+
+import rospy
+import rospkg
+
+# part of every cache key. bump it whenever the FK, the choice of links or the array
+# layout changes, so entries written by an older version are never loaded
+POSE_CACHE_FORMAT_VERSION = 1
+
+class PoseTransformCache :
+    # on-disk store of the link transforms of end effector stored poses. each entry
+    # is an (S x L x 4 x 4) .npy array (state x link) next to a small json index of
+    # the state and link names, keyed by a hash of the cache format version and the
+    # models it was computed from.
+
+    def __init__(self, directory=None) :
+        if directory == None :
+            directory = os.path.join(rospkg.get_ros_home(), "nasa_robot_teleop", "pose_cache")
+        self.directory = directory
+        # key -> Event set when the build of that entry in progress finishes
+        self.builds = {}
+        self.mutex = threading.Lock()
+
+    def get_key(self, urdf_xml, srdf_xml, group) :
+        h = hashlib.sha1()
+        for s in (str(POSE_CACHE_FORMAT_VERSION), urdf_xml, srdf_xml, group) :
+            if s == None : s = ""
+            if isinstance(s, unicode) : s = s.encode('utf-8')
+            h.update(s)
+            h.update('\0')
+        return h.hexdigest()
+
+    def get_paths(self, key) :
+        base = os.path.join(self.directory, key)
+        return (base + ".npy", base + ".json")
+
+    def load(self, key) :
+        # returns (states, links, transforms) with transforms memory mapped, or None
+        (data_path, index_path) = self.get_paths(key)
+        if not os.path.exists(data_path) or not os.path.exists(index_path) : return None
+        try :
+            with open(index_path) as f :
+                index = json.load(f)
+            transforms = numpy.load(data_path, mmap_mode='r')
+        except (IOError, ValueError) :
+            rospy.logwarn("PoseTransformCache::load() -- could not read cache entry " + key)
+            return None
+        if transforms.shape != (len(index["states"]), len(index["links"]), 4, 4) :
+            rospy.logwarn("PoseTransformCache::load() -- cache entry " + key + " is inconsistent, ignoring")
+            return None
+        return (index["states"], index["links"], transforms)
+
+    def save(self, key, states, links, transforms) :
+        (data_path, index_path) = self.get_paths(key)
+        temp_paths = []
+        try :
+            if not os.path.isdir(self.directory) : os.makedirs(self.directory)
+            # write to temporary files unique to this writer and rename them, so readers
+            # never see a partial entry and concurrent writers never share a file
+            (fd, data_temp) = tempfile.mkstemp(suffix=".npy.tmp", dir=self.directory)
+            temp_paths.append(data_temp)
+            with os.fdopen(fd, "wb") as f :
+                numpy.save(f, numpy.asarray(transforms, dtype=numpy.float64))
+            (fd, index_temp) = tempfile.mkstemp(suffix=".json.tmp", dir=self.directory)
+            temp_paths.append(index_temp)
+            with os.fdopen(fd, "w") as f :
+                json.dump({"states" : list(states), "links" : list(links)}, f)
+            os.rename(data_temp, data_path)
+            os.rename(index_temp, index_path)
+            return True
+        except (IOError, OSError) as e :
+            rospy.logwarn("PoseTransformCache::save() -- could not write cache entry " + key + ": " + str(e))
+            for path in temp_paths :
+                if os.path.exists(path) : os.remove(path)
+            return False
+
+    def begin_build(self, key) :
+        # True if the caller should build the entry for key, False if another caller
+        # already is, in which case wait_for_build() tells when it is done
+        with self.mutex :
+            if key in self.builds : return False
+            self.builds[key] = threading.Event()
+            return True
+
+    def end_build(self, key) :
+        with self.mutex :
+            event = self.builds.pop(key, None)
+        if event != None : event.set()
+
+    def wait_for_build(self, key, timeout) :
+        # True once no build of key is in progress, False if timeout (seconds) passed first
+        with self.mutex :
+            event = self.builds.get(key)
+        if event == None : return True
+        return event.wait(timeout)
@@ -3,50 +3,58 @@
 import rospy
 import roslib
 
-import threading
-import geometry_msgs
-import PyKDL as kdl
-
-from nasa_robot_teleop.kdl_posemath import *
-
-class PoseUpdateThread(threading.Thread) :
-    def __init__(self, name, root_frame, control_frame, tf_listener, offset_pose) :
-        super(PoseUpdateThread,self).__init__()
-        self.mutex = threading.Lock()
-        self.name = name
-        self.pose_data = geometry_msgs.msg.PoseStamped()
-        self.tf_listener = tf_listener
+from nasa_robot_teleop.frame_tracker import *
+
+class PoseUpdateThread(FrameTracker) :
+    # a FrameTracker with its own thread for a single control frame. with event_driven
+    # set, the thread sleeps until tf changes a transform between root_frame and
+    # control_frame (or staleness_timeout passes) instead of polling. in both modes it
+    # updates at most max_rate times a second.
+    def __init__(self, name, root_frame, control_frame, tf_listener, offset_pose, event_driven=False, max_rate=10.0, staleness_timeout=1.0, translation_threshold=0.0, rotation_threshold=0.0) :
+        super(PoseUpdateThread,self).__init__(tf_listener, rate=max_rate, event_driven=event_driven, staleness_timeout=staleness_timeout, name=name)
         self.control_frame = control_frame
         self.root_frame = root_frame
-        self.is_valid = False
         self.offset_pose = offset_pose
-        self.T_offset = kdl.Frame()
-        if offset_pose != None :
-            self.T_offset = fromMsg(self.offset_pose)
-
-        self.running = True
-
-    def run(self) :
-        while self.running :
-            # self.mutex.acquire()
-            # try :
-            #     try :
-            self.tf_listener.waitForTransform(self.control_frame,self.root_frame, rospy.Time(0), rospy.Duration(3.0))
-            (trans, rot) = self.tf_listener.lookupTransform(self.root_frame, self.control_frame, rospy.Time(0))
-            T = fromMsg(toPose(trans, rot))
-            self.pose_data = toMsg(T*self.T_offset)
-            self.is_valid = True
-            #     except :
-            #         rospy.logdebug("PoseUpdateThread::run() -- could not update thread")
-            # finally :
-            #     self.mutex.release()
-
-            rospy.sleep(0.1)
-        print "Killing Pose Update Thread: ", self.name
-
-    def stop(self) :
-        self.running = False
+        self.tracked_frame = self.register(root_frame, control_frame, offset_pose, translation_threshold=translation_threshold, rotation_threshold=rotation_threshold)
+
+    @property
+    def pose_data(self) :
+        return self.tracked_frame.pose_data
+
+    @property
+    def is_valid(self) :
+        return self.tracked_frame.is_valid
+
+    def get_version(self) :
+        return self.tracked_frame.get_version()
 
     def get_pose_data(self) :
-        self.is_valid = False
-        return self.pose_data
+        return self.tracked_frame.get_pose_data()
+
+    def wait_for_next_pose(self, timeout) :
+        return self.tracked_frame.wait_for_next_pose(timeout)
+
+    def get_pose_at(self, stamp) :
+        # pose of the control frame at stamp, interpolated from the recent history
+        return self.tracked_frame.get_pose_at(stamp)
+
+    def get_history(self) :
+        return self.tracked_frame.get_history()
+
+
+class MultiPoseUpdateThread(FrameTracker) :
+    # a FrameTracker with its own thread for a set of frames resolved against the same
+    # root each tick and published together as a PoseSnapshot
+    def __init__(self, name, root_frame, tf_listener, offset_poses, rate=10.0, event_driven=False, staleness_timeout=1.0, translation_threshold=0.0, rotation_threshold=0.0) :
+        super(MultiPoseUpdateThread,self).__init__(tf_listener, rate=rate, event_driven=event_driven, staleness_timeout=staleness_timeout, name=name)
+        self.root_frame = root_frame
+        self.frame_set = self.register_set(root_frame, offset_poses, translation_threshold=translation_threshold, rotation_threshold=rotation_threshold)
+
+    def get_pose_data(self, frame) :
+        return self.frame_set.get_pose_data(frame)
+
+    def get_snapshot(self) :
+        return self.frame_set.get_snapshot()
+
+    def get_version(self) :
+        return self.frame_set.get_version()
@@ -14,35 +14,46 @@ def normalize_vector(v) :
     m = math.sqrt(math.fsum([x*x for x in v]))
     return [x/m for x in v]
 
-def get_x_rotation_frame(theta) :
-    T = kdl.Frame()
-    T.M.DoRotX(theta)
-    return T
+def get_joint_axis(joint) :
+    # URDF defaults to the x axis when none is given
+    if joint.axis :
+        return normalize_vector(joint.axis)
+    return [1.0, 0.0, 0.0]
 
-def get_y_rotation_frame(theta) :
-    T = kdl.Frame()
-    T.M.DoRotY(theta)
-    return T
+def get_rotation_kernel(axis) :
+    # axis aligned joints get the cheap single-axis KDL rotation, with the
+    # axis sign folded in up front. everything else rotates about the axis.
+    if axis == [1.0, 0.0, 0.0] : return lambda q : kdl.Frame(kdl.Rotation.RotX(q))
+    if axis == [-1.0, 0.0, 0.0] : return lambda q : kdl.Frame(kdl.Rotation.RotX(-q))
+    if axis == [0.0, 1.0, 0.0] : return lambda q : kdl.Frame(kdl.Rotation.RotY(q))
+    if axis == [0.0, -1.0, 0.0] : return lambda q : kdl.Frame(kdl.Rotation.RotY(-q))
+    if axis == [0.0, 0.0, 1.0] : return lambda q : kdl.Frame(kdl.Rotation.RotZ(q))
+    if axis == [0.0, 0.0, -1.0] : return lambda q : kdl.Frame(kdl.Rotation.RotZ(-q))
+    v = kdl.Vector(axis[0], axis[1], axis[2])
+    return lambda q : kdl.Frame(kdl.Rotation.Rot2(v, q))
 
-def get_z_rotation_frame(theta) :
-    T = kdl.Frame()
-    T.M.DoRotZ(theta)
-    return T
+def get_translation_kernel(axis) :
+    v = kdl.Vector(axis[0], axis[1], axis[2])
+    return lambda q : kdl.Frame(v*q)
 
-def get_joint_rotation(axis, joint_val) :
-    if axis[0] > 0 :
-        T_joint = get_x_rotation_frame(joint_val)
-    elif axis[0] < 0 :
-        T_joint = get_x_rotation_frame(-joint_val)
-    elif axis[1] > 0 :
-        T_joint = get_y_rotation_frame(joint_val)
-    elif axis[1] < 0 :
-        T_joint = get_y_rotation_frame(-joint_val)
-    elif axis[2] < 0 :
-        T_joint = get_z_rotation_frame(-joint_val)
-    else :
-        T_joint = get_z_rotation_frame(joint_val)
-    return T_joint
+JOINT_KERNELS = {
+    'revolute' : get_rotation_kernel,
+    'continuous' : get_rotation_kernel,
+    'prismatic' : get_translation_kernel,
+}
+
+def get_joint_kernel(joint) :
+    # returns a function mapping a joint value to the joint's motion frame, or
+    # None for joints (fixed, floating, planar) that only contribute their origin
+    if joint.type in JOINT_KERNELS :
+        return JOINT_KERNELS[joint.type](get_joint_axis(joint))
+    return None
+
+def get_joint_kernels(urdf) :
+    kernels = {}
+    for j in urdf.joint_map :
+        kernels[j] = get_joint_kernel(urdf.joint_map[j])
+    return kernels
 
 def link_has_mesh(link) :
     if link.visual :
@@ -92,12 +103,18 @@ def joint_origin_to_pose(joint) :
             p.orientation.w = q[3]
     return p
 
+def get_static_offset(root, tip, urdf) :
+    # frame of tip in root when only fixed joints lie between them, otherwise None
+    if not urdf.is_in_subtree(tip, root) : return None
+    chain = urdf.get_chain(root, tip, links=False)
+    T = kdl.Frame()
+    for j in chain :
+        if urdf.joint_map[j].type != "fixed" : return None
+        T = T*urdf.get_joint_origin_frame(j)
+    return T
+
 def get_parent_link(link, urdf) :
-    for j in urdf.joint_map :
-        if urdf.joint_map[j].child == link :
-            return urdf.joint_map[j].parent
+    return urdf.get_parent_link(link)
 
 def get_link_joint(link, urdf) :
-    for j in urdf.joint_map :
-        if urdf.joint_map[j].child == link :
-            return j
\ No newline at end of file
+    return urdf.get_parent_joint(link)
\ No newline at end of file
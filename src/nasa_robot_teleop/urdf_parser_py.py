@@ -396,9 +396,26 @@ class Robot(xmlr.Object):
         self.parent_map = {}
         self.child_map = {}
 
+        # the xml this model was parsed from, when loaded from the parameter server
+        self.xml_string = None
+
+        # static origin frames (PyKDL), see build_origin_frames()
+        self.joint_origin_frames = {}
+        self.visual_origin_frames = {}
+
+        # kinematic tree index, see build_tree_index()
+        self.link_depths = {}
+        self.subtree_intervals = {}
+
     def add_aggregate(self, typeName, elem):
         xmlr.Object.add_aggregate(self, typeName, elem)
 
+        # the model changed, so any cached origin frames and tree index are stale
+        self.joint_origin_frames = {}
+        self.visual_origin_frames = {}
+        self.link_depths = {}
+        self.subtree_intervals = {}
+
         if typeName == 'joint':
             joint = elem
             self.joint_map[joint.name] = joint
@@ -442,6 +459,118 @@ class Robot(xmlr.Object):
         assert root is not None, "No roots detected, invalid URDF."
         return root
 
+    def build_origin_frames(self):
+        """
+        Precompute the joint origin and link visual origin frames
+        as PyKDL frames. The cached frames are shared and must not
+        be modified in place.
+        """
+        import PyKDL as kdl
+
+        def origin_to_frame(origin):
+            T = kdl.Frame()
+            if origin:
+                if origin.xyz:
+                    T.p = kdl.Vector(origin.xyz[0], origin.xyz[1], origin.xyz[2])
+                if origin.rpy:
+                    T.M = kdl.Rotation.RPY(origin.rpy[0], origin.rpy[1], origin.rpy[2])
+            return T
+
+        joint_origin_frames = {}
+        for name, joint in self.joint_map.items():
+            joint_origin_frames[name] = origin_to_frame(joint.origin)
+
+        visual_origin_frames = {}
+        for name, link in self.link_map.items():
+            if link.visual:
+                visual_origin_frames[name] = origin_to_frame(link.visual.origin)
+            else:
+                visual_origin_frames[name] = kdl.Frame()
+
+        self.joint_origin_frames = joint_origin_frames
+        self.visual_origin_frames = visual_origin_frames
+
+    def get_joint_origin_frame(self, joint):
+        if not self.joint_origin_frames:
+            self.build_origin_frames()
+        return self.joint_origin_frames[joint]
+
+    def get_visual_origin_frame(self, link):
+        if not self.visual_origin_frames:
+            self.build_origin_frames()
+        return self.visual_origin_frames[link]
+
+    def build_tree_index(self):
+        """
+        Index the kinematic tree for fast queries. Every link gets
+        its depth below the root and a [first, last] preorder interval
+        that contains the intervals of all links in its subtree.
+        """
+        link_depths = {}
+        subtree_intervals = {}
+        roots = [link for link in self.link_map if link not in self.parent_map]
+        count = 0
+        for root in roots:
+            link_depths[root] = 0
+            stack = [(root, False)]
+            while stack:
+                (link, done) = stack.pop()
+                if done:
+                    subtree_intervals[link] = (subtree_intervals[link], count - 1)
+                    continue
+                subtree_intervals[link] = count
+                count += 1
+                stack.append((link, True))
+                for (joint, child) in reversed(self.child_map.get(link, [])):
+                    link_depths[child] = link_depths[link] + 1
+                    stack.append((child, False))
+        self.link_depths = link_depths
+        self.subtree_intervals = subtree_intervals
+
+    def get_parent_link(self, link):
+        if link in self.parent_map:
+            return self.parent_map[link][1]
+        return None
+
+    def get_parent_joint(self, link):
+        if link in self.parent_map:
+            return self.parent_map[link][0]
+        return None
+
+    def get_child_links(self, link):
+        return [child for (joint, child) in self.child_map.get(link, [])]
+
+    def get_link_depth(self, link):
+        if not self.link_depths:
+            self.build_tree_index()
+        return self.link_depths[link]
+
+    def is_in_subtree(self, link, root):
+        """ True if link is root or one of its descendants. """
+        if not self.subtree_intervals:
+            self.build_tree_index()
+        if root not in self.subtree_intervals or link not in self.subtree_intervals:
+            return False
+        (first, last) = self.subtree_intervals[root]
+        return first <= self.subtree_intervals[link][0] <= last
+
+    def get_common_ancestor(self, a, b):
+        """ Lowest common ancestor of two links, or None if they are in different trees. """
+        da = self.get_link_depth(a)
+        db = self.get_link_depth(b)
+        while da > db:
+            a = self.parent_map[a][1]
+            da -= 1
+        while db > da:
+            b = self.parent_map[b][1]
+            db -= 1
+        while a != b:
+            if a not in self.parent_map:
+                return None
+            a = self.parent_map[a][1]
+            b = self.parent_map[b][1]
+        return a
+
     @classmethod
     def from_parameter_server(cls, key = 'robot_description'):
         """
@@ -452,7 +581,12 @@ class Robot(xmlr.Object):
         """
         # Could move this into xml_reflection
         import rospy
-        return cls.from_xml_string(rospy.get_param(key))
+        xml_string = rospy.get_param(key)
+        robot = cls.from_xml_string(xml_string)
+        robot.xml_string = xml_string
+        robot.build_origin_frames()
+        robot.build_tree_index()
+        return robot
 
 xmlr.reflect(Robot, tag = 'robot', params = [
 #   name_attribute,